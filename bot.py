@@ -20,14 +20,19 @@ NEU:
   sowie Guthaben ändern per Benutzer-ID
 """
 
-import os, json, time, threading, sqlite3, uuid, random, string, re, hashlib, secrets
+import os, sys, io, csv, json, base64, time, threading, queue, asyncio, sqlite3, uuid, random, string, re, hashlib, secrets, functools, heapq, itertools
 from decimal import Decimal, ROUND_DOWN
 from datetime import datetime, timezone, timedelta
+from collections import deque, OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeout, as_completed
 
 from dotenv import load_dotenv
 import requests
+import websockets
 import telebot
 from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton
+from telebot.apihelper import ApiTelegramException
 
 # -------- Solana (Version 0.25.0) --------
 from solana.keypair import Keypair
@@ -36,6 +41,10 @@ from solana.system_program import transfer, TransferParams
 from solana.rpc.api import Client
 from solana.transaction import Transaction
 from solana.rpc.types import TxOpts
+from solana.rpc.core import RPCException
+from spl.memo.instructions import create_memo, MemoParams
+from spl.memo.constants import MEMO_PROGRAM_ID
+from based58 import b58encode, b58decode
 
 # ------------------ ENV ---------------------
 load_dotenv()
@@ -43,6 +52,9 @@ BOT_TOKEN     = os.getenv("BOT_TOKEN","8222875136:AAFF-A-DqFiT7ahzsLZuraAgQj27OY
 ADMIN_IDS     = [int(x) for x in os.getenv("ADMIN_IDS","8076025426").split(",") if x.strip().isdigit()]
 DEFAULT_LANG  = os.getenv("DEFAULT_LANG","en").strip().lower()
 SOL_RPC_URL   = os.getenv("SOL_RPC_URL","https://api.mainnet-beta.solana.com").strip()
+SOL_RPC_URLS  = [u.strip() for u in os.getenv("SOL_RPC_URLS","").split(",") if u.strip()] or [SOL_RPC_URL]
+SOL_WS_URL    = (os.getenv("SOL_WS_URL","").strip()
+                 or SOL_RPC_URL.replace("https://","wss://",1).replace("http://","ws://",1))
 
 FEE_FNF = Decimal(os.getenv("FEE_FNF","2.0"))              # %
 FEE_ESCROW_EXTRA = Decimal(os.getenv("FEE_ESCROW_EXTRA","3.0"))  # %
@@ -51,6 +63,62 @@ MIN_DEPOSIT_SOL   = Decimal(os.getenv("MIN_DEPOSIT_SOL","0.0005"))
 MIN_WITHDRAW_SOL  = Decimal(os.getenv("MIN_WITHDRAW_SOL","0.0005"))
 MAX_WITHDRAW_SOL  = Decimal(os.getenv("MAX_WITHDRAW_SOL","50"))
 DEPOSIT_POLL_SECONDS = int(os.getenv("DEPOSIT_POLL_SECONDS","15"))
+SCAN_PAGE_LIMIT      = max(1, min(1000, int(os.getenv("SCAN_PAGE_LIMIT","1000"))))  # getSignaturesForAddress max 1000
+RPC_BATCH_MAX        = max(1, int(os.getenv("RPC_BATCH_MAX","50")))                  # Calls pro JSON-RPC-Batch
+RPC_RPS              = float(os.getenv("RPC_RPS","10"))                             # Requests/s beim Provider (0 = unbegrenzt)
+RPC_EJECT_AFTER      = max(1, int(os.getenv("RPC_EJECT_AFTER","3")))                # Fehler in Folge → Endpoint pausieren
+RPC_EJECT_SECONDS    = float(os.getenv("RPC_EJECT_SECONDS","30"))                  # erste Pause, verdoppelt sich
+RPC_HEDGE            = os.getenv("RPC_HEDGE","0").strip() == "1"                   # Lesezugriffe nach p95 doppelt stellen
+RPC_FETCH_WORKERS    = max(1, int(os.getenv("RPC_FETCH_WORKERS","4")))              # parallele Tx-Fetches
+DEPOSIT_WS           = os.getenv("DEPOSIT_WS","0").strip() == "1"                # Push-Erkennung per PubSub
+DEPOSIT_WS_MODE      = os.getenv("DEPOSIT_WS_MODE","logs").strip().lower()          # logs | account
+DEPOSIT_WS_POLL_SECONDS = int(os.getenv("DEPOSIT_WS_POLL_SECONDS","120"))          # Sicherheits-Poll bei aktivem WS
+DEPOSIT_MISSING_SECONDS = float(os.getenv("DEPOSIT_MISSING_SECONDS","600"))      # gelistete Tx so lange nicht abrufbar → überspringen
+TX_ENCODING          = os.getenv("TX_ENCODING","base64").strip()                    # getTransaction: base64 | json | jsonParsed
+DEDUP_CACHE_SIZE     = int(os.getenv("DEDUP_CACHE_SIZE","20000"))                 # Signaturen im RAM-Fenster
+DEDUP_KEEP_SLOTS     = int(os.getenv("DEDUP_KEEP_SLOTS","216000"))                 # ~1 Tag unter dem Cursor behalten
+DEDUP_PRUNE_SECONDS  = int(os.getenv("DEDUP_PRUNE_SECONDS","3600"))
+DB_GROUP_COMMIT_MS   = float(os.getenv("DB_GROUP_COMMIT_MS","0"))                 # >0: Writer wartet so lange auf weitere Jobs vor COMMIT
+DB_BUSY_TIMEOUT_MS   = int(os.getenv("DB_BUSY_TIMEOUT_MS","5000"))                 # Wartezeit bei gesperrter DB (andere Prozesse)
+DB_STMT_CACHE        = int(os.getenv("DB_STMT_CACHE","256"))                       # vorbereitete Statements je Connection
+DB_MAX_BATCH         = int(os.getenv("DB_MAX_BATCH","500"))                        # max. Jobs je Writer-COMMIT
+BACKFILL_TO_SLOT     = int(os.getenv("BACKFILL_TO_SLOT","0") or 0)                  # >0: Backfill beim Start
+USERNAME_CACHE_SIZE  = int(os.getenv("USERNAME_CACHE_SIZE","5000"))                # user_id → username im RAM
+USERNAME_CACHE_TTL   = int(os.getenv("USERNAME_CACHE_TTL","600"))
+USERNAME_LOOKUP_SIZE = int(os.getenv("USERNAME_LOOKUP_SIZE","2000"))               # @name → user_id (Empfängersuche)
+PROFILE_CACHE_SIZE   = int(os.getenv("PROFILE_CACHE_SIZE","10000"))                # Nutzerprofile (users-Zeile) im RAM
+PROFILE_CACHE_TTL    = int(os.getenv("PROFILE_CACHE_TTL","60"))                     # Sekunden; Änderungen hier invalidieren sofort
+WITHDRAW_WORKERS     = max(1, int(os.getenv("WITHDRAW_WORKERS","2")))               # Threads für Auszahlungs-Jobs
+WITHDRAW_CHECK_SECONDS = float(os.getenv("WITHDRAW_CHECK_SECONDS","3"))            # Takt des Status-Trackers
+WITHDRAW_MAX_ATTEMPTS = int(os.getenv("WITHDRAW_MAX_ATTEMPTS","3"))                # Neu-Signieren nach Blockhash-Ablauf, danach Erstattung
+WITHDRAW_EXPIRE_MARGIN = int(os.getenv("WITHDRAW_EXPIRE_MARGIN","30"))             # Blöcke über lastValidBlockHeight, bevor eine Tx als abgelaufen gilt
+PAYOUT_MAX_ROWS      = int(os.getenv("PAYOUT_MAX_ROWS","5000"))                    # Zeilen je Sammel-Auszahlung (CSV)
+PAYOUT_MAX_PER_TX    = int(os.getenv("PAYOUT_MAX_PER_TX","0"))                      # >0: Transfers je Tx zusätzlich begrenzen
+OUTBOX_RPS           = float(os.getenv("OUTBOX_RPS","25"))                          # Telegram: ~30 Nachrichten/s global
+OUTBOX_CHAT_INTERVAL = float(os.getenv("OUTBOX_CHAT_INTERVAL","1.0"))               # Abstand je Privat-Chat (s)
+OUTBOX_GROUP_INTERVAL = float(os.getenv("OUTBOX_GROUP_INTERVAL","3.0"))             # Abstand je Gruppe (20/min)
+OUTBOX_WORKERS       = max(1, int(os.getenv("OUTBOX_WORKERS","4")))
+BOT_MODE             = os.getenv("BOT_MODE","polling").strip().lower()               # polling | webhook
+WEBHOOK_URL          = os.getenv("WEBHOOK_URL","").strip().rstrip("/")               # öffentliche Basis-URL (TLS am Reverse-Proxy)
+WEBHOOK_LISTEN       = os.getenv("WEBHOOK_LISTEN","127.0.0.1").strip()
+WEBHOOK_PORT         = int(os.getenv("WEBHOOK_PORT","8080"))
+WEBHOOK_SECRET       = os.getenv("WEBHOOK_SECRET","").strip()                       # X-Telegram-Bot-Api-Secret-Token
+UPDATE_WORKERS       = max(1, int(os.getenv("UPDATE_WORKERS","8")))                 # Shards (je user_id genau einer)
+UPDATE_QUEUE_MAX     = int(os.getenv("UPDATE_QUEUE_MAX","200"))                     # Updates je Shard, danach Backpressure
+WITHDRAW_SWEEP_SECONDS = float(os.getenv("WITHDRAW_SWEEP_SECONDS","2"))            # fällige Jobs aus der DB einplanen
+BLOCKHASH_REFRESH_SECONDS = float(os.getenv("BLOCKHASH_REFRESH_SECONDS","5"))      # Hintergrund-Refresh des Blockhash
+BLOCKHASH_SAFETY_BLOCKS = int(os.getenv("BLOCKHASH_SAFETY_BLOCKS","60"))           # so viele Blöcke vor Ablauf nicht mehr nutzen
+CONV_TTL             = int(os.getenv("CONV_TTL","900"))                            # Sekunden bis ein offener Dialogschritt verfällt
+CONV_MAX             = int(os.getenv("CONV_MAX","10000"))                          # offene Dialoge im RAM, älteste fallen raus
+CONV_PERSIST         = os.getenv("CONV_PERSIST","1").strip() == "1"                 # offene Schritte in conv_state → überleben Neustarts
+TWOFA_CODE_TTL       = int(os.getenv("TWOFA_CODE_TTL","300"))                      # Gültigkeit eines 2FA-Codes (s)
+THROTTLE_MENU        = os.getenv("THROTTLE_MENU","2/10")                            # je Nutzer: Tokens/s / Vorrat
+THROTTLE_HEAVY       = os.getenv("THROTTLE_HEAVY","0.5/4")                          # Verlauf, Admin-Statistik, CSV
+THROTTLE_MONEY       = os.getenv("THROTTLE_MONEY","0.5/5")                          # Senden, Auszahlen, Escrow, Passwort/2FA
+THROTTLE_HEAVY_SLOTS = int(os.getenv("THROTTLE_HEAVY_SLOTS","4"))                   # gleichzeitige heavy-Handler (global)
+THROTTLE_HEAVY_WAIT  = float(os.getenv("THROTTLE_HEAVY_WAIT","2"))                  # so lange auf freien Slot warten (s)
+THROTTLE_WARN_SECONDS = int(os.getenv("THROTTLE_WARN_SECONDS","5"))                # Hinweis „zu schnell“ höchstens so oft
+THROTTLE_USERS       = int(os.getenv("THROTTLE_USERS","20000"))                     # Nutzer mit Buckets im RAM
 
 CENTRAL_WALLET_SECRET = os.getenv("CENTRAL_WALLET_SECRET","[216,228,184,240,28,208,86,251,72,207,66,95,46,213,227,92,3,151,107,135,207,35,239,106,204,30,183,73,9,76,39,133,231,92,227,79,168,2,181,228,68,217,227,49,92,136,161,209,206,110,146,237,79,243,145,54,121,109,106,22,160,136,164,90]").strip()
 CENTRAL_WALLET_ADDRESS = os.getenv("CENTRAL_WALLET_ADDRESS","Ga9L4teyfbnJcxhhErKAquF8cHy3GR6XPF1sqxji3DN9").strip()
@@ -71,14 +139,198 @@ try:
 except Exception as e:
     raise SystemExit(f"Ungültiger CENTRAL_WALLET_SECRET: {e}")
 
-# RPC
-rpc  = Client(SOL_RPC_URL)
+# RPC (Endpoint-Pool: siehe RPC helper)
 sess = requests.Session()
 
+ASSETS = {"SOL": 9}   # Asset → Dezimalstellen (DB speichert ganzzahlig in 10^-dec)
+
 # ------------------ DB ----------------------
 DB="proofpay.db"
-conn = sqlite3.connect(DB, check_same_thread=False)
-conn.row_factory = sqlite3.Row
+class _Result:
+    """Vollständig gelesenes Statement-Ergebnis. Der Cursor ist danach geschlossen, damit
+    Reader keinen alten WAL-Snapshot festhalten und der Writer nichts zurückgibt, was er noch nutzt."""
+    def __init__(self, cur):
+        self.rowcount = cur.rowcount
+        self.lastrowid = cur.lastrowid
+        self.rows = cur.fetchall() if cur.description else []
+        cur.close()
+    def fetchone(self): return self.rows[0] if self.rows else None
+    def fetchall(self): return list(self.rows)
+    def __iter__(self): return iter(self.rows)
+
+class _WriteJob:
+    def __init__(self, fn):
+        self.fn = fn; self.result = None; self.error = None
+        self.done = threading.Event()
+
+class Storage:
+    """Thread-sicherer Ersatz für die frühere globale sqlite3-Connection (gleiche execute/commit-API).
+    - Lesen: eine Read-only-Connection pro Thread (WAL → parallel, sieht nur Committetes).
+    - Schreiben: genau ein Writer-Thread mit eigener Connection, gefüttert über eine Queue.
+      Einzelne Statements werden dort ausgeführt; der Writer committet gesammelt, der Aufrufer wartet
+      bis zum COMMIT. lease() leiht die Writer-Connection für einen ganzen Block (ledger_tx).
+    - Jede Connection: WAL, synchronous=NORMAL, busy_timeout, Statement-Cache."""
+    READ_PREFIXES = ("SELECT", "PRAGMA TABLE_INFO", "WITH")
+
+    def __init__(self, path):
+        self.path = path
+        self.wconn = self._connect()
+        self.wconn.execute("PRAGMA journal_mode=WAL")
+        self._tls = threading.local()
+        self.q = queue.Queue()
+        self.writer = None
+        self._start_lock = threading.Lock()
+        self._abort = None   # Savepoint nicht mehr zurücksetzbar → ganzer Batch scheitert
+
+    def _connect(self, readonly=False):
+        # Reader im Autocommit: nie eine (Lese-)Transaktion offen lassen
+        c = sqlite3.connect(self.path, check_same_thread=False, timeout=DB_BUSY_TIMEOUT_MS/1000.0,
+                            cached_statements=DB_STMT_CACHE, **({"isolation_level": None} if readonly else {}))
+        c.row_factory = sqlite3.Row
+        c.execute(f"PRAGMA busy_timeout={int(DB_BUSY_TIMEOUT_MS)}")
+        c.execute("PRAGMA synchronous=NORMAL")   # in WAL sicher gegen Korruption, fsync nur beim Checkpoint
+        if readonly: c.execute("PRAGMA query_only=1")
+        return c
+
+    def in_writer(self):
+        return getattr(self._tls, "writer", 0) > 0 or threading.current_thread() is self.writer
+
+    def reader(self):
+        c = getattr(self._tls, "rconn", None)
+        if c is None:
+            c = self._tls.rconn = self._connect(readonly=True)
+        return c
+
+    # --- sqlite3.Connection-API ---
+    def execute(self, sql, params=()):
+        if self.in_writer():
+            return self.wconn.execute(sql, params)
+        if sql.lstrip()[:17].upper().startswith(self.READ_PREFIXES):
+            return _Result(self.reader().execute(sql, params))
+        return self.submit(lambda c: _Result(c.execute(sql, params)))
+
+    def executemany(self, sql, seq):
+        if self.in_writer():
+            return self.wconn.executemany(sql, seq)
+        seq = list(seq)
+        return self.submit(lambda c: _Result(c.executemany(sql, seq)))
+
+    def cursor(self):
+        return (self.wconn if self.in_writer() else self.reader()).cursor()
+
+    def commit(self):
+        # Außerhalb von direct() committet der Writer selbst
+        if getattr(self._tls, "direct", False): self.wconn.commit()
+
+    def rollback(self):
+        if getattr(self._tls, "direct", False): self.wconn.rollback()
+
+    @contextmanager
+    def direct(self):
+        """Writer-Connection direkt im aufrufenden Thread nutzen (nur Start/Migration, bevor Threads laufen)."""
+        self._tls.writer = getattr(self._tls, "writer", 0) + 1; self._tls.direct = True
+        try: yield self.wconn
+        finally:
+            self._tls.writer -= 1; self._tls.direct = False
+
+    # --- Writer ---
+    def _ensure_writer(self):
+        if self.writer is None:
+            with self._start_lock:
+                if self.writer is None:
+                    self.writer = threading.Thread(target=self._writer_loop, name="db-writer", daemon=True)
+                    self.writer.start()
+
+    def _enqueue(self, fn):
+        self._ensure_writer()
+        job = _WriteJob(fn); self.q.put(job)
+        return job
+
+    def submit(self, fn):
+        """fn(conn) im Writer-Thread in eigener Savepoint-Transaktion; Rückgabe nach COMMIT."""
+        if self.in_writer(): return fn(self.wconn)
+        job = self._enqueue(fn); job.done.wait()
+        if job.error: raise job.error
+        return job.result
+
+    @contextmanager
+    def lease(self):
+        """Writer-Connection für die Dauer des Blocks exklusiv im aufrufenden Thread.
+        Fehler im Block → Rollback nur dieses Blocks; sonst Rückkehr erst nach COMMIT."""
+        ready = threading.Event(); release = threading.Event(); box = {}
+        def hold(c):
+            ready.set(); release.wait()
+            if "exc" in box: raise box["exc"]
+        job = self._enqueue(hold)
+        while not ready.wait(0.05):
+            if job.done.is_set(): raise job.error or RuntimeError("DB-Writer nicht verfügbar")
+        self._tls.writer = getattr(self._tls, "writer", 0) + 1
+        try:
+            yield self.wconn
+        except BaseException as e:
+            self._tls.writer -= 1
+            box["exc"] = e; release.set(); job.done.wait()
+            raise
+        self._tls.writer -= 1
+        release.set(); job.done.wait()
+        if job.error: raise job.error
+
+    def _run(self, job):
+        c = self.wconn
+        try:
+            if not c.in_transaction: c.execute("BEGIN IMMEDIATE")
+            c.execute("SAVEPOINT job")
+        except Exception as e:
+            job.error = e; return
+        try:
+            job.result = job.fn(c)
+            c.execute("RELEASE job")
+        except BaseException as e:
+            job.error = e
+            try:
+                c.execute("ROLLBACK TO job"); c.execute("RELEASE job")
+            except Exception as e2:
+                self._abort = e2
+
+    def _writer_loop(self):
+        window = DB_GROUP_COMMIT_MS / 1000.0
+        while True:
+            batch = [self.q.get()]
+            end = time.monotonic() + window
+            i = 0
+            while True:
+                self._run(batch[i]); i += 1
+                if i < len(batch): continue
+                if len(batch) >= DB_MAX_BATCH: break
+                try:
+                    wait = end - time.monotonic()
+                    batch.append(self.q.get(timeout=wait) if wait > 0 else self.q.get_nowait())
+                except queue.Empty:
+                    break
+            err, self._abort = self._abort, None
+            try:
+                if err: raise err
+                if self.wconn.in_transaction: self.wconn.commit()
+            except Exception as e:
+                err = e
+                try: self.wconn.rollback()
+                except Exception: pass
+            for job in batch:
+                if err and not job.error: job.error = err
+                job.done.set()
+
+conn = Storage(DB)
+
+# --- Ledger-Transaktionen (Unit of Work) ---
+@contextmanager
+def ledger_tx():
+    """Alle Ledger-Änderungen im Block (bal_adj, tx_log_add, ...) landen atomar in einer SQLite-Transaktion
+    auf der Writer-Connection. Verschachtelt → gehört zur äußeren. Gleichzeitige Blöcke teilen sich
+    einen COMMIT (DB_GROUP_COMMIT_MS verlängert das Sammelfenster)."""
+    if conn.in_writer():
+        yield conn; return
+    with conn.lease():
+        yield conn
 
 def init_db():
     c = conn.cursor()
@@ -90,17 +342,19 @@ def init_db():
         ref_code TEXT, ref_by INTEGER,
         created_at TEXT
     )""")
+    # Beträge in kleinster Einheit (Lamports bei SOL), siehe to_units/from_units
     c.execute("""CREATE TABLE IF NOT EXISTS balances(
-        user_id INTEGER, asset TEXT, available REAL DEFAULT 0, held REAL DEFAULT 0,
+        user_id INTEGER, asset TEXT, available INTEGER NOT NULL DEFAULT 0, held INTEGER NOT NULL DEFAULT 0,
         PRIMARY KEY(user_id,asset)
     )""")
     c.execute("""CREATE TABLE IF NOT EXISTS tx_log(
         id TEXT PRIMARY KEY,
         type TEXT,          -- deposit|send|escrow_hold|escrow_release|withdraw
         user_from INTEGER, user_to INTEGER,
-        asset TEXT, amount REAL, fee REAL,
+        asset TEXT, amount INTEGER, fee INTEGER,
         chain_sig TEXT, meta TEXT,
-        created_at TEXT
+        created_at TEXT,
+        created_ts INTEGER  -- Unix-Millisekunden (für Index/Sortierung)
     )""")
     c.execute("""CREATE TABLE IF NOT EXISTS deposit_seen(
         sig TEXT PRIMARY KEY
@@ -112,14 +366,51 @@ def init_db():
         PRIMARY KEY(user_id, source_addr)
     )""")
     conn.commit()
-init_db()
+with conn.direct():
+    init_db()
 
 # --- Schema-Erweiterungen (NEU) ---
 def column_exists(table, col):
     r = conn.execute(f"PRAGMA table_info({table})").fetchall()
     return any(row["name"] == col for row in r)
 
+def column_type(table, col):
+    for row in conn.execute(f"PRAGMA table_info({table})").fetchall():
+        if row["name"] == col: return (row["type"] or "").upper()
+    return None
+
+def migrate_units():
+    """Alt-DBs: balances/tx_log von REAL (SOL) auf INTEGER (Lamports) umbauen – einmalig, in einer Transaktion."""
+    if column_type("balances","available") != "REAL": return
+    scale = "CASE asset " + " ".join(f"WHEN '{a}' THEN {10**d}" for a, d in ASSETS.items()) + " ELSE 1000000000 END"
+    conn.commit()
+    conn.execute("BEGIN")
+    try:
+        conn.execute("""CREATE TABLE balances_new(
+            user_id INTEGER, asset TEXT, available INTEGER NOT NULL DEFAULT 0, held INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY(user_id,asset))""")
+        conn.execute(f"""INSERT INTO balances_new(user_id,asset,available,held)
+                         SELECT user_id, asset, CAST(ROUND(COALESCE(available,0)*{scale}) AS INTEGER),
+                                CAST(ROUND(COALESCE(held,0)*{scale}) AS INTEGER) FROM balances""")
+        conn.execute("DROP TABLE balances")
+        conn.execute("ALTER TABLE balances_new RENAME TO balances")
+        conn.execute("""CREATE TABLE tx_log_new(
+            id TEXT PRIMARY KEY, type TEXT, user_from INTEGER, user_to INTEGER,
+            asset TEXT, amount INTEGER, fee INTEGER, chain_sig TEXT, meta TEXT, created_at TEXT)""")
+        conn.execute(f"""INSERT INTO tx_log_new(id,type,user_from,user_to,asset,amount,fee,chain_sig,meta,created_at)
+                         SELECT id, type, user_from, user_to, asset,
+                                CAST(ROUND(COALESCE(amount,0)*{scale}) AS INTEGER),
+                                CAST(ROUND(COALESCE(fee,0)*{scale}) AS INTEGER),
+                                chain_sig, meta, created_at FROM tx_log""")
+        conn.execute("DROP TABLE tx_log")
+        conn.execute("ALTER TABLE tx_log_new RENAME TO tx_log")
+        conn.commit()
+    except Exception:
+        conn.rollback(); raise
+    print("DB migriert: Beträge jetzt in Lamports (INTEGER).")
+
 def ensure_schema():
+    migrate_units()
     # Passwort-Felder
     if not column_exists("users","pass_enabled"):
         conn.execute("ALTER TABLE users ADD COLUMN pass_enabled INTEGER DEFAULT 0")
@@ -127,8 +418,159 @@ def ensure_schema():
         conn.execute("ALTER TABLE users ADD COLUMN pw_hash TEXT")
     if not column_exists("users","pw_salt"):
         conn.execute("ALTER TABLE users ADD COLUMN pw_salt TEXT")
+    # Scanner-Cursor (letzte verarbeitete Signatur/Slot) + Backfill-Checkpoint
+    conn.execute("""CREATE TABLE IF NOT EXISTS scan_cursor(
+        name TEXT PRIMARY KEY,
+        sig TEXT, slot INTEGER,
+        meta TEXT,
+        updated_at TEXT
+    )""")
+    # Versionszähler (per Trigger) – erkennt Änderungen auch aus anderen Prozessen
+    conn.execute("""CREATE TABLE IF NOT EXISTS counters(
+        name TEXT PRIMARY KEY,
+        value INTEGER NOT NULL DEFAULT 0
+    )""")
+    conn.execute("INSERT OR IGNORE INTO counters(name,value) VALUES('expected_sources',0)")
+    # Dedup: Slot je Signatur (für Pruning) + Gutschriften über tx_log.chain_sig auffindbar
+    if not column_exists("deposit_seen","slot"):
+        conn.execute("ALTER TABLE deposit_seen ADD COLUMN slot INTEGER")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_deposit_seen_slot ON deposit_seen(slot)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_tx_log_chain_sig ON tx_log(chain_sig)")
+    # Verlauf: Epoch-Zeitstempel + Index je Teilnehmer (Keyset-Pagination)
+    if not column_exists("tx_log","created_ts"):
+        conn.execute("ALTER TABLE tx_log ADD COLUMN created_ts INTEGER")
+    conn.execute("UPDATE tx_log SET created_ts=CAST(ROUND((julianday(created_at)-2440587.5)*86400000) AS INTEGER) WHERE created_ts IS NULL")
+    for r in conn.execute("SELECT id, created_at FROM tx_log WHERE created_ts IS NULL").fetchall():
+        try: ts = int(datetime.fromisoformat(r["created_at"]).replace(tzinfo=timezone.utc).timestamp()*1000)
+        except Exception: ts = 0
+        conn.execute("UPDATE tx_log SET created_ts=? WHERE id=?", (ts, r["id"]))
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_tx_log_from_ts ON tx_log(user_from, created_ts, id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_tx_log_to_ts ON tx_log(user_to, created_ts, id)")
+    # Normalisierter Username (lowercase, ohne @) mit Unique-Index → Empfängersuche per Index statt lower()-Scan.
+    # Bei Altbestand mit Dubletten bekommt nur der zuletzt angelegte Nutzer den Namen.
+    if not column_exists("users","username_lc"):
+        conn.execute("ALTER TABLE users ADD COLUMN username_lc TEXT")
+        conn.execute("""UPDATE users SET username_lc=lower(username)
+                        WHERE user_id<>0 AND rowid IN (SELECT max(rowid) FROM users WHERE user_id<>0 AND coalesce(username,'')<>''
+                                                       GROUP BY lower(username))""")
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_users_username_lc ON users(username_lc)")
+    for ev in ("INSERT","DELETE","UPDATE"):
+        conn.execute(f"""CREATE TRIGGER IF NOT EXISTS expected_sources_ver_{ev.lower()} AFTER {ev} ON expected_sources
+                         BEGIN UPDATE counters SET value=value+1 WHERE name='expected_sources'; END""")
+    # Auszahlungen als Jobs: queued → submitted → confirmed | failed → refunded
+    conn.execute("""CREATE TABLE IF NOT EXISTS withdrawals(
+        id TEXT PRIMARY KEY,
+        user_id INTEGER NOT NULL, chat_id INTEGER,
+        asset TEXT NOT NULL, amount INTEGER NOT NULL, to_addr TEXT NOT NULL,
+        state TEXT NOT NULL, sig TEXT, error TEXT,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        created_ts INTEGER, updated_ts INTEGER, next_ts INTEGER NOT NULL DEFAULT 0
+    )""")
+    for col in ("last_valid_height","submitted_ts","confirmed_ts","finalized_ts","confirm_ms"):
+        if not column_exists("withdrawals",col):
+            conn.execute(f"ALTER TABLE withdrawals ADD COLUMN {col} INTEGER")
+    if not column_exists("withdrawals","chain_status"):
+        conn.execute("ALTER TABLE withdrawals ADD COLUMN chain_status TEXT")
+    # Vom Tracker verfolgt: gesendet oder bestätigt, aber noch nicht finalisiert
+    conn.execute(f"CREATE INDEX IF NOT EXISTS idx_withdrawals_tracked ON withdrawals(state) WHERE {WD_TRACKED}")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_withdrawals_confirmed ON withdrawals(confirmed_ts)")
+    # Sammel-Auszahlungen (Admin-CSV): ein withdrawals-Job je On-Chain-Tx mit vielen Transfers (batch_id),
+    # die einzelnen Zeilen in payout_items (belastetes Konto, Ziel, Betrag, Ergebnis)
+    if not column_exists("withdrawals","batch_id"):
+        conn.execute("ALTER TABLE withdrawals ADD COLUMN batch_id TEXT")
+    conn.execute("""CREATE TABLE IF NOT EXISTS payout_batches(
+        id TEXT PRIMARY KEY, admin_id INTEGER, chat_id INTEGER,
+        rows INTEGER, created_ts INTEGER, done_ts INTEGER
+    )""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS payout_items(
+        batch_id TEXT, row_no INTEGER, target TEXT,
+        debit_uid INTEGER, to_addr TEXT, amount INTEGER,
+        wd_id TEXT, state TEXT NOT NULL, error TEXT,
+        PRIMARY KEY(batch_id,row_no)
+    )""")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_payout_items_wd ON payout_items(wd_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_withdrawals_state ON withdrawals(state, next_ts)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_withdrawals_user ON withdrawals(user_id, created_ts)")
+    # Offene Dialogschritte je Chat (siehe ConvStore)
+    conn.execute("""CREATE TABLE IF NOT EXISTS conv_state(
+        chat_id INTEGER PRIMARY KEY,
+        state TEXT NOT NULL, data TEXT,
+        expires_ts INTEGER NOT NULL
+    )""")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_conv_state_expires ON conv_state(expires_ts)")
+    ensure_stats_schema()
     conn.commit()
-ensure_schema()
+
+WD_TRACKED = "state='submitted' OR (state='confirmed' AND finalized_ts IS NULL)"
+
+# Admin-Statistik: laufende Summen in counters (stats_*) + Tages-Rollups, per Trigger in derselben
+# Transaktion wie die Ledger-Schreibzugriffe gepflegt → Admin-Ansicht liest nur wenige kleine Zeilen.
+STATS_DAY = "date(NEW.created_ts/1000,'unixepoch')"
+STATS_COUNTERS = ("stats_fees", "stats_users", "stats_held")
+
+def ensure_stats_schema():
+    conn.execute("""CREATE TABLE IF NOT EXISTS stats_daily(
+        day TEXT, type TEXT,
+        n INTEGER NOT NULL DEFAULT 0, volume INTEGER NOT NULL DEFAULT 0, fees INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY(day,type)
+    ) WITHOUT ROWID""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS stats_daily_users(
+        day TEXT, user_id INTEGER, PRIMARY KEY(day,user_id)
+    ) WITHOUT ROWID""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS stats_daily_active(
+        day TEXT PRIMARY KEY, users INTEGER NOT NULL DEFAULT 0
+    )""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS user_last_active(
+        user_id INTEGER PRIMARY KEY, day TEXT NOT NULL
+    )""")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_user_last_active_day ON user_last_active(day)")
+    fresh = not conn.execute("SELECT 1 FROM counters WHERE name='stats_fees'").fetchone()
+    touch = lambda col: f"""INSERT OR IGNORE INTO stats_daily_users(day,user_id) SELECT {STATS_DAY}, NEW.{col} WHERE NEW.{col}>0;
+        INSERT INTO user_last_active(user_id,day) SELECT NEW.{col}, {STATS_DAY} WHERE NEW.{col}>0
+          ON CONFLICT(user_id) DO UPDATE SET day=max(day, excluded.day);"""
+    conn.execute(f"""CREATE TRIGGER IF NOT EXISTS stats_tx_log_insert AFTER INSERT ON tx_log BEGIN
+        INSERT INTO stats_daily(day,type,n,volume,fees) VALUES({STATS_DAY}, NEW.type, 1, COALESCE(NEW.amount,0), COALESCE(NEW.fee,0))
+          ON CONFLICT(day,type) DO UPDATE SET n=n+1, volume=volume+excluded.volume, fees=fees+excluded.fees;
+        UPDATE counters SET value=value+COALESCE(NEW.fee,0) WHERE name='stats_fees';
+        {touch("user_from")}
+        {touch("user_to")}
+    END""")
+    conn.execute("""CREATE TRIGGER IF NOT EXISTS stats_daily_users_insert AFTER INSERT ON stats_daily_users BEGIN
+        INSERT INTO stats_daily_active(day,users) VALUES(NEW.day,1) ON CONFLICT(day) DO UPDATE SET users=users+1;
+    END""")
+    conn.execute("""CREATE TRIGGER IF NOT EXISTS stats_users_insert AFTER INSERT ON users WHEN NEW.user_id>0 BEGIN
+        UPDATE counters SET value=value+1 WHERE name='stats_users'; END""")
+    conn.execute("""CREATE TRIGGER IF NOT EXISTS stats_users_delete AFTER DELETE ON users WHEN OLD.user_id>0 BEGIN
+        UPDATE counters SET value=value-1 WHERE name='stats_users'; END""")
+    conn.execute("""CREATE TRIGGER IF NOT EXISTS stats_held_update AFTER UPDATE OF held ON balances
+        WHEN NEW.user_id>0 AND NEW.asset='SOL' AND NEW.held<>OLD.held BEGIN
+        UPDATE counters SET value=value+NEW.held-OLD.held WHERE name='stats_held'; END""")
+    conn.execute("""CREATE TRIGGER IF NOT EXISTS stats_held_insert AFTER INSERT ON balances
+        WHEN NEW.user_id>0 AND NEW.asset='SOL' AND NEW.held<>0 BEGIN
+        UPDATE counters SET value=value+NEW.held WHERE name='stats_held'; END""")
+    if fresh: stats_rebuild()
+
+def stats_rebuild():
+    """Alle Statistiken einmal vollständig aus tx_log/users/balances berechnen (Erstbefüllung / Reparatur)."""
+    day = "date(created_ts/1000,'unixepoch')"
+    for t in ("stats_daily", "stats_daily_users", "stats_daily_active", "user_last_active"):
+        conn.execute(f"DELETE FROM {t}")
+    conn.execute(f"""INSERT INTO stats_daily(day,type,n,volume,fees)
+                     SELECT {day}, type, COUNT(*), COALESCE(SUM(amount),0), COALESCE(SUM(fee),0) FROM tx_log GROUP BY 1,2""")
+    conn.execute(f"""INSERT OR IGNORE INTO stats_daily_users(day,user_id)
+                     SELECT {day}, user_from FROM tx_log WHERE user_from>0
+                     UNION SELECT {day}, user_to FROM tx_log WHERE user_to>0""")
+    conn.execute("DELETE FROM stats_daily_active")   # Insert-Trigger oben hat schon gezählt – exakt neu setzen
+    conn.execute("INSERT INTO stats_daily_active(day,users) SELECT day, COUNT(*) FROM stats_daily_users GROUP BY day")
+    conn.execute("INSERT INTO user_last_active(user_id,day) SELECT user_id, max(day) FROM stats_daily_users GROUP BY user_id")
+    totals = {"stats_fees":  "SELECT COALESCE(SUM(fee),0) FROM tx_log",
+              "stats_users": "SELECT COUNT(*) FROM users WHERE user_id>0",
+              "stats_held":  "SELECT COALESCE(SUM(held),0) FROM balances WHERE asset='SOL' AND user_id>0"}
+    for name in STATS_COUNTERS:
+        conn.execute("INSERT INTO counters(name,value) VALUES(?,0) ON CONFLICT(name) DO NOTHING", (name,))
+        conn.execute(f"UPDATE counters SET value=({totals[name]}) WHERE name=?", (name,))
+with conn.direct():
+    ensure_schema()
 
 # System-User/Balances sicherstellen (wichtig für Gebühren!)
 def ensure_system():
@@ -154,52 +596,187 @@ def ensure_system():
     if not b:
         conn.execute("INSERT INTO balances(user_id, asset, available, held) VALUES(0,'SOL',0,0)")
         conn.commit()
-ensure_system()
-
-ASSETS = {"SOL": 9}
+with conn.direct():
+    ensure_system()
 
 def now_iso(): return datetime.now(timezone.utc).isoformat()
+def now_ms(): return int(time.time()*1000)
 def dquant(x, dec): return Decimal(x).quantize(Decimal(10) ** -dec, rounding=ROUND_DOWN)
-def fmt(asset, x): return f"{dquant(Decimal(x), ASSETS[asset])} {asset}"
+def fmt(asset, x): return f"{dquant(Decimal(x), ASSETS[asset]):f} {asset}"   # :f → nie Exponent (0E-9)
+def fnum(x): return f"{Decimal(x):f}"   # Zahl ohne Einheit, ebenfalls ohne Exponent
+def to_units(asset, x): return int((Decimal(x) * (10 ** ASSETS[asset])).to_integral_value(rounding=ROUND_DOWN))
+def from_units(asset, n): return dquant(Decimal(int(n or 0)) / (10 ** ASSETS[asset]), ASSETS[asset])
+def fmt_u(asset, n): return fmt(asset, from_units(asset, n))
 def is_admin(uid): return uid in ADMIN_IDS
 
+def norm_username(u):
+    return (u or "").strip().lstrip("@").lower() or None
+
+def _claim_username(c, uid, username):
+    """Username (neu/umbenannt) für uid setzen; ein veralteter Eintrag eines anderen Nutzers
+    mit demselben Namen wird freigegeben (Telegram-Namen sind jeweils nur einmal vergeben)."""
+    lc = norm_username(username)
+    if lc: c.execute("UPDATE users SET username_lc=NULL WHERE username_lc=? AND user_id<>?", (lc, uid))
+    c.execute("UPDATE users SET username=?, username_lc=? WHERE user_id=?", (username or "", lc, uid))
+
 def ensure_user(tu, ref_by=None):
-    r = conn.execute("SELECT * FROM users WHERE user_id=?", (tu.id,)).fetchone()
+    r = get_user(tu.id)
     if not r:
         code = f"R{tu.id}"
-        conn.execute("""INSERT INTO users(user_id,username,first_name,last_name,lang,twofa_enabled,ref_code,ref_by,created_at,pass_enabled,pw_hash,pw_salt)
-                        VALUES(?,?,?,?,?,?,?,?,?,0,NULL,NULL)""",
-                     (tu.id, tu.username or "", tu.first_name or "", tu.last_name or "",
-                      DEFAULT_LANG if DEFAULT_LANG in ("de","en") else "en", 1, code, ref_by, now_iso()))
-        for a in ASSETS: conn.execute("INSERT INTO balances(user_id,asset,available,held) VALUES(?,?,0,0)", (tu.id, a))
-        conn.commit()
-
-def get_user(uid): return conn.execute("SELECT * FROM users WHERE user_id=?", (uid,)).fetchone()
-def get_user_by_username(u):
-    if not u: return None
-    return conn.execute("SELECT * FROM users WHERE lower(username)=?", (u.lstrip("@").lower(),)).fetchone()
-def get_username(uid):
-    r = conn.execute("SELECT username FROM users WHERE user_id=?", (uid,)).fetchone()
-    return (r["username"] or str(uid)) if r else str(uid)
+        def create(c):
+            c.execute("""INSERT OR IGNORE INTO users(user_id,username,first_name,last_name,lang,twofa_enabled,ref_code,ref_by,created_at,pass_enabled,pw_hash,pw_salt)
+                         VALUES(?,?,?,?,?,?,?,?,?,0,NULL,NULL)""",
+                      (tu.id, "", tu.first_name or "", tu.last_name or "",
+                       DEFAULT_LANG if DEFAULT_LANG in ("de","en") else "en", 1, code, ref_by, now_iso()))
+            _claim_username(c, tu.id, tu.username)
+            for a in ASSETS: c.execute("INSERT OR IGNORE INTO balances(user_id,asset,available,held) VALUES(?,?,0,0)", (tu.id, a))
+        conn.submit(create)
+        invalidate_user(tu.id)
+    elif (r["username"] or "") != (tu.username or ""):
+        # Umbenennung: nur bei Änderung schreiben, Caches für alten + neuen Namen verwerfen
+        conn.submit(lambda c: _claim_username(c, tu.id, tu.username))
+        invalidate_user(tu.id)
+        _uname_lookup.pop(norm_username(r["username"])); _uname_lookup.pop(norm_username(tu.username))
+
+class LRUCache:
+    """Threadsicherer LRU-Cache mit fester Größe und optionaler TTL (Sekunden, 0 = unbegrenzt)."""
+    _MISS = object()
+    def __init__(self, maxsize, ttl=0):
+        self.maxsize, self.ttl = max(1, maxsize), ttl
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            hit = self.data.get(key, self._MISS)
+            if hit is self._MISS: return default
+            val, exp = hit
+            if exp and exp < time.monotonic():
+                del self.data[key]; return default
+            self.data.move_to_end(key)
+            return val
+
+    def put(self, key, val):
+        with self.lock:
+            self.data[key] = (val, time.monotonic() + self.ttl if self.ttl else 0)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def pop(self, key):
+        with self.lock: self.data.pop(key, None)
+
+    def clear(self):
+        with self.lock: self.data.clear()
+
+# --- Nutzerprofile: prozessweiter Cache + Kontext je Update ---
+_profile_cache = LRUCache(PROFILE_CACHE_SIZE, PROFILE_CACHE_TTL)
+_req = threading.local()
+
+@contextmanager
+def request_scope():
+    """Kontext für ein Update: jeder Nutzer wird darin höchstens einmal geladen. Verschachtelt → äußerer gilt."""
+    if getattr(_req, "users", None) is not None:
+        yield; return
+    _req.users = {}
+    try: yield
+    finally: _req.users = None
+
+def per_update(fn):
+    @functools.wraps(fn)
+    def wrap(*a, **kw):
+        with request_scope(): return fn(*a, **kw)
+    return wrap
+
+def get_user(uid):
+    scope = getattr(_req, "users", None)
+    if scope is not None and uid in scope: return scope[uid]
+    r = _profile_cache.get(uid)
+    if r is None:
+        r = conn.execute("SELECT * FROM users WHERE user_id=?", (uid,)).fetchone()
+        if r is not None: _profile_cache.put(uid, r)
+    if scope is not None: scope[uid] = r
+    return r
+
+def invalidate_user(uid):
+    _profile_cache.pop(uid); _uname_cache.pop(uid)
+    scope = getattr(_req, "users", None)
+    if scope is not None: scope.pop(uid, None)
+
+def update_user(uid, **cols):
+    """Profilfelder schreiben und Caches für uid verwerfen."""
+    conn.execute(f"UPDATE users SET {', '.join(k+'=?' for k in cols)} WHERE user_id=?", (*cols.values(), uid))
+    invalidate_user(uid)
+
+def user_lang(uid):
+    u = get_user(uid)
+    lang = (u["lang"] if u else DEFAULT_LANG) or DEFAULT_LANG
+    lang = lang.lower() if isinstance(lang, str) else DEFAULT_LANG
+    return lang if lang in I18N else (DEFAULT_LANG if DEFAULT_LANG in I18N else "en")
+
+_uname_cache = LRUCache(USERNAME_CACHE_SIZE, USERNAME_CACHE_TTL)
+
+def usernames(uids):
+    """user_id → Anzeigename für alle uids; Cache-Misses mit einer IN-Query je 400 IDs."""
+    out, miss = {}, []
+    for uid in dict.fromkeys(u for u in uids if u is not None):
+        name = _uname_cache.get(uid)
+        if name is None: miss.append(uid)
+        else: out[uid] = name
+    for off in range(0, len(miss), 400):
+        part = miss[off:off+400]
+        rows = conn.execute(f"SELECT user_id, username FROM users WHERE user_id IN ({','.join('?'*len(part))})", part).fetchall()
+        for r in rows:
+            out[r["user_id"]] = r["username"] or str(r["user_id"])
+            _uname_cache.put(r["user_id"], out[r["user_id"]])
+    for uid in miss: out.setdefault(uid, str(uid))   # unbekannte IDs nicht cachen
+    return out
+
+def get_username(uid): return usernames([uid])[uid]
+
+_uname_lookup = LRUCache(USERNAME_LOOKUP_SIZE, USERNAME_CACHE_TTL)
+
+def lookup_username(u):
+    """@name → (user_id, username) oder None; Treffer aus dem LRU, sonst Index-Lookup auf username_lc."""
+    lc = norm_username(u)
+    if not lc: return None
+    hit = _uname_lookup.get(lc)
+    if hit: return hit
+    r = conn.execute("SELECT user_id, username FROM users WHERE username_lc=?", (lc,)).fetchone()
+    if not r: return None
+    hit = (r["user_id"], r["username"] or str(r["user_id"]))
+    _uname_lookup.put(lc, hit)
+    return hit
+
+class InsufficientBalance(ValueError):
+    pass
 
 def bal(uid, asset):
     r = conn.execute("SELECT available,held FROM balances WHERE user_id=? AND asset=?", (uid, asset)).fetchone()
-    if not r:
-        conn.execute("INSERT OR IGNORE INTO balances(user_id,asset,available,held) VALUES(?,?,0,0)", (uid, asset))
-        conn.commit()
-        r = conn.execute("SELECT available,held FROM balances WHERE user_id=? AND asset=?", (uid, asset)).fetchone()
-    return Decimal(str(r["available"])), Decimal(str(r["held"]))
-
-def bal_set(uid, asset, av=None, hd=None):
-    a,h = bal(uid, asset)
-    if av is None: av = a
-    if hd is None: hd = h
-    conn.execute("UPDATE balances SET available=?, held=? WHERE user_id=? AND asset=?",
-                 (float(av), float(hd), uid, asset)); conn.commit()
+    if not r: return Decimal("0"), Decimal("0")
+    return from_units(asset, r["available"]), from_units(asset, r["held"])
 
 def bal_adj(uid, asset, da=Decimal("0"), dh=Decimal("0")):
-    a,h = bal(uid, asset)
-    bal_set(uid, asset, a+da, h+dh)
+    """Atomare Änderung in einem UPDATE; verweigert (InsufficientBalance), wenn ein Saldo negativ würde.
+    Außerhalb von ledger_tx() eigene Transaktion, innerhalb Teil der umgebenden."""
+    ua, uh = to_units(asset, da), to_units(asset, dh)
+    sql = """UPDATE balances SET available=available+?, held=held+?
+             WHERE user_id=? AND asset=? AND available+?>=0 AND held+?>=0"""
+    with ledger_tx():
+        if conn.execute(sql, (ua, uh, uid, asset, ua, uh)).rowcount == 0:
+            if conn.execute("SELECT 1 FROM balances WHERE user_id=? AND asset=?", (uid, asset)).fetchone():
+                raise InsufficientBalance(f"{uid}/{asset}")
+            conn.execute("INSERT OR IGNORE INTO balances(user_id,asset,available,held) VALUES(?,?,0,0)", (uid, asset))
+            if conn.execute(sql, (ua, uh, uid, asset, ua, uh)).rowcount == 0:
+                raise InsufficientBalance(f"{uid}/{asset}")
+
+def tx_log_add(typ, user_from, user_to, asset, amount, fee=Decimal("0"), chain_sig=None, meta=None, t_id=None):
+    """Neuer tx_log-Eintrag (Beträge als Decimal, gespeichert in Einheiten). Nur innerhalb von ledger_tx() nutzen."""
+    t_id = t_id or str(uuid.uuid4())
+    conn.execute("INSERT INTO tx_log(id,type,user_from,user_to,asset,amount,fee,chain_sig,meta,created_at,created_ts) VALUES(?,?,?,?,?,?,?,?,?,?,?)",
+                 (t_id, typ, user_from, user_to, asset, to_units(asset, amount), to_units(asset, fee),
+                  chain_sig, json.dumps(meta or {}), now_iso(), now_ms()))
+    return t_id
 
 # ---------- Passwort Utils ----------
 def _hash_pw(pw:str, salt:str)->str:
@@ -243,7 +820,9 @@ I18N = {
   "withdraw_addr":"➖ <b>Auszahlen</b>\nSende Ziel-Adresse (SOL, Base58). Mindestbetrag: {min}",
   "withdraw_amt":"Gib Betrag in SOL ein (min {min}, max {max}).",
   "withdraw_ok":"💸 Auszahlung erstellt: {amt} SOL\nTx: <code>{sig}</code>",
+  "withdraw_queued":"⏳ Auszahlung über {amt} SOL eingereiht – du bekommst eine Nachricht, sobald sie bestätigt ist.",
   "history_none":"(Noch keine Transaktionen.)",
+  "btn_older":"⬅️ Älter", "btn_newer":"Neuer ➡️",
   "settings":"⚙️ <b>Einstellungen</b>\n• Sprache: <b>{lang}</b>\n• 2FA: <b>{twofa}</b>\n• Dein Referral-Code: <code>{ref}</code>\n• Passwortschutz: <b>{pw}</b>",
   "twofa_toggled":"🔐 2FA ist jetzt: {st}",
   "support_prompt":"🆘 Beschreibe dein Anliegen. Wir antworten hier im Chat.",
@@ -262,6 +841,10 @@ I18N = {
   "pw_short":"❌ Das Passwort ist zu kurz.",
   "pw_ask":"🔑 Bitte gib dein Passwort ein:",
   "pw_wrong":"❌ Falsches Passwort.",
+  "twofa_code":"🔐 2FA – antworte mit: <code>{code}</code> (gültig {min} Min.)",
+  "step_expired":"⌛ Zu lange gewartet – der Vorgang wurde abgebrochen. Bitte neu starten.",
+  "throttled":"🐢 Zu viele Anfragen – bitte kurz warten.",
+  "busy":"⏳ Gerade viel los – bitte gleich nochmal versuchen.",
   # Neu: About/Policies/Help
   "about_text": "ℹ️ <b>Über uns</b>\n"
                 "1) ProofPay ermöglicht sichere Krypto-Zahlungen in Telegram.\n"
@@ -299,6 +882,13 @@ I18N = {
   # Admin
   "admin_title":"🛠️ <b>Adminbereich</b>\nGebühren gesamt: {fee}\nNutzer gesamt: {users}\nAktive Nutzer (30T): {active}\nEscrow gehalten: {held}\n",
   "admin_btn_edit_balance":"✏️ Guthaben ändern",
+  "admin_btn_stats":"📊 {days} Tage",
+  "admin_btn_payout":"📦 Sammel-Auszahlung (CSV)",
+  "admin_payout_prompt":"Sende eine CSV (Datei oder Text), je Zeile <code>Ziel,Betrag</code>.\nZiel = UserID (Auszahlung vom Guthaben an die Quell-Wallet des Nutzers) oder Solana-Adresse (aus dem Gebührenkonto).",
+  "admin_payout_empty":"❌ Keine gültigen Zeilen (max. {max}).",
+  "admin_payout_created":"📦 Sammel-Auszahlung {id}: {ok} Zeilen reserviert, {rejected} abgelehnt, {txs} Transaktionen. Ergebnis folgt als CSV.",
+  "admin_payout_done":"📦 Sammel-Auszahlung fertig: {paid} bezahlt, {refunded} erstattet, {rejected} abgelehnt.",
+  "admin_stats_title":"📊 <b>Statistik {days} Tage</b>\nAktive Nutzer: {active}\nGebühren: {fee}\n",
   "admin_edit_prompt":"Sende: <code>UserID Betrag</code> (z. B. <code>123456 0.5</code> für +0.5 SOL; negative Werte für Abzug).",
   "admin_edit_ok":"✅ Guthaben angepasst. Neuer Stand: {av}",
   "admin_edit_err":"❌ Eingabe ungültig oder Nutzer nicht gefunden."
@@ -329,7 +919,9 @@ I18N = {
   "withdraw_addr":"➖ <b>Withdraw</b>\nSend target address (SOL, Base58). Minimum: {min}",
   "withdraw_amt":"Enter amount in SOL (min {min}, max {max}).",
   "withdraw_ok":"💸 Withdrawal created: {amt} SOL\nTx: <code>{sig}</code>",
+  "withdraw_queued":"⏳ Withdrawal of {amt} SOL queued – you'll get a message once it is confirmed.",
   "history_none":"(No transactions yet.)",
+  "btn_older":"⬅️ Older", "btn_newer":"Newer ➡️",
   "settings":"⚙️ <b>Settings</b>\n• Language: <b>{lang}</b>\n• 2FA: <b>{twofa}</b>\n• Your referral code: <code>{ref}</code>\n• Password lock: <b>{pw}</b>",
   "twofa_toggled":"🔐 2FA is now: {st}",
   "support_prompt":"🆘 Describe your issue. We’ll reply here.",
@@ -348,6 +940,10 @@ I18N = {
   "pw_short":"❌ Password too short.",
   "pw_ask":"🔑 Please enter your password:",
   "pw_wrong":"❌ Wrong password.",
+  "twofa_code":"🔐 2FA – reply with: <code>{code}</code> (valid {min} min)",
+  "step_expired":"⌛ Timed out – the action was cancelled. Please start again.",
+  "throttled":"🐢 Too many requests – please slow down.",
+  "busy":"⏳ Busy right now – please try again in a moment.",
   # About/Policies/Help
   "about_text":"ℹ️ <b>About us</b>\n"
                "1) ProofPay enables secure crypto payments in Telegram.\n"
@@ -385,54 +981,98 @@ I18N = {
   # Admin
   "admin_title":"🛠️ <b>Admin</b>\nTotal fees: {fee}\nUsers: {users}\nActive users (30d): {active}\nEscrow held: {held}\n",
   "admin_btn_edit_balance":"✏️ Edit balance",
+  "admin_btn_stats":"📊 {days} days",
+  "admin_btn_payout":"📦 Bulk payout (CSV)",
+  "admin_payout_prompt":"Send a CSV (file or text), one <code>target,amount</code> per line.\nTarget = user ID (paid from the user's balance to their source wallet) or a Solana address (paid from the fee account).",
+  "admin_payout_empty":"❌ No valid rows (max. {max}).",
+  "admin_payout_created":"📦 Bulk payout {id}: {ok} rows reserved, {rejected} rejected, {txs} transactions. Result follows as CSV.",
+  "admin_payout_done":"📦 Bulk payout finished: {paid} paid, {refunded} refunded, {rejected} rejected.",
+  "admin_stats_title":"📊 <b>Stats {days} days</b>\nActive users: {active}\nFees: {fee}\n",
   "admin_edit_prompt":"Send: <code>UserID Amount</code> (e.g. <code>123456 0.5</code> for +0.5 SOL; negative for debit).",
   "admin_edit_ok":"✅ Balance updated. New available: {av}",
   "admin_edit_err":"❌ Invalid input or user not found."
  }
 }
 
+# Kompilierter Katalog: lang → key → (Text, Platzhalter). Fehlende Schlüssel sind mit dem
+# en-Text aufgefüllt; Probleme werden beim Start (bzw. beim ersten Auftreten) einmal gemeldet.
+I18N_C = {}
+_i18n_reported = set()
+_fmt = string.Formatter()
+
+def i18n_warn(msg):
+    if msg not in _i18n_reported:
+        _i18n_reported.add(msg); print("I18N:", msg)
+
+def _placeholders(text):
+    return frozenset(re.split(r"[.\[]", f)[0] for _, f, _, _ in _fmt.parse(text) if f)
+
+def compile_i18n():
+    keys = set().union(*I18N.values())
+    base = I18N.get("en", {})
+    for lang, texts in I18N.items():
+        cat = {}
+        for key in keys:
+            text = texts.get(key)
+            if text is None:
+                i18n_warn(f"{lang}: '{key}' fehlt, nutze en")
+                text = base.get(key) or next(t[key] for t in I18N.values() if key in t)
+            try:
+                fields = _placeholders(text)
+                if not fields: text = text.format()   # {{ }} auflösen, danach nie mehr formatieren
+            except ValueError as e:
+                i18n_warn(f"{lang}: '{key}' ungültiges Template ({e})"); fields = frozenset()
+            cat[key] = (text, fields)
+        I18N_C[lang] = cat
+    for key in keys:
+        variants = {lang: sorted(cat[key][1]) for lang, cat in I18N_C.items()}
+        if len({tuple(v) for v in variants.values()}) > 1:
+            i18n_warn(f"'{key}' Platzhalter je Sprache verschieden: {variants}")
+
+compile_i18n()
+
 def T(uid, key, **kw):
+    ent = I18N_C[user_lang(uid)].get(key)
+    if ent is None:
+        i18n_warn(f"unbekannter Schlüssel '{key}'"); return key
+    text, fields = ent
+    if not fields: return text
     try:
-        u = get_user(uid)
-        lang = (u["lang"] if u else DEFAULT_LANG) or DEFAULT_LANG
-        if not isinstance(lang, str):
-            lang = DEFAULT_LANG
-        lang = lang.lower()
-        if lang not in I18N:
-            lang = DEFAULT_LANG if DEFAULT_LANG in I18N else "en"
-        texts = I18N.get(lang, I18N.get("en", {}))
-        template = texts.get(key, I18N.get("en", {}).get(key, key))
-        return template.format(**kw)
-    except Exception:
-        return I18N.get("en", {}).get(key, key)
+        return text.format(**kw)
+    except (KeyError, IndexError, ValueError) as e:
+        i18n_warn(f"'{key}': Platzhalter {e} nicht übergeben"); return text
 
 # ------------------ UI ----------------------
-bot = telebot.TeleBot(BOT_TOKEN, parse_mode="HTML")
+# threaded=False: Handler laufen im Shard-Worker des Dispatchers (Reihenfolge je Nutzer), nicht in telebots Pool
+bot = telebot.TeleBot(BOT_TOKEN, parse_mode="HTML", threaded=False)
+
+class FrozenMarkup(InlineKeyboardMarkup):
+    """Vorgebautes, geteiltes Inline-Keyboard: Zeilen als Tupel (unveränderlich), JSON einmal serialisiert."""
+    def __init__(self, kb):
+        super().__init__()
+        self.keyboard = tuple(tuple(row) for row in kb.keyboard)
+        self._dict = super().to_dict()
+        self._json = json.dumps(self._dict)
+    def to_dict(self): return self._dict
+    def to_json(self): return self._json
+
+def _build_menu(lang, admin):
+    L = I18N_C[lang]; b = lambda key, cb: InlineKeyboardButton(L[key][0], callback_data=cb)
+    kb = InlineKeyboardMarkup()
+    kb.add(b("btn_balance", "m:bal"))
+    kb.add(b("btn_deposit", "m:dep"),  b("btn_send", "m:send"))
+    kb.add(b("btn_withdraw", "m:wd"),  b("btn_history", "m:hist"))
+    kb.add(b("btn_settings", "m:set"), b("btn_support", "m:sup"))
+    kb.add(b("btn_about", "m:about"),  b("btn_policies", "m:pol"))
+    kb.add(b("btn_help", "m:help"))
+    if admin: kb.add(b("btn_admin", "m:admin"))
+    return FrozenMarkup(kb)
+
+# Nur (Sprache × Rolle) Varianten → einmal bauen
+MENUS = {(lang, admin): _build_menu(lang, admin) for lang in I18N_C for admin in (False, True)}
 
 def menu(uid):
-    u = get_user(uid)
-    kb = InlineKeyboardMarkup()
-    kb.add(InlineKeyboardButton(I18N[u["lang"]]["btn_balance"], callback_data="m:bal"))
-    kb.add(
-        InlineKeyboardButton(I18N[u["lang"]]["btn_deposit"], callback_data="m:dep"),
-        InlineKeyboardButton(I18N[u["lang"]]["btn_send"],    callback_data="m:send")
-    )
-    kb.add(
-        InlineKeyboardButton(I18N[u["lang"]]["btn_withdraw"], callback_data="m:wd"),
-        InlineKeyboardButton(I18N[u["lang"]]["btn_history"],  callback_data="m:hist")
-    )
-    kb.add(
-        InlineKeyboardButton(I18N[u["lang"]]["btn_settings"], callback_data="m:set"),
-        InlineKeyboardButton(I18N[u["lang"]]["btn_support"],  callback_data="m:sup")
-    )
-    kb.add(
-        InlineKeyboardButton(I18N[u["lang"]]["btn_about"],     callback_data="m:about"),
-        InlineKeyboardButton(I18N[u["lang"]]["btn_policies"],  callback_data="m:pol")
-    )
-    kb.add(InlineKeyboardButton(I18N[u["lang"]]["btn_help"], callback_data="m:help"))
-    if is_admin(uid):
-        kb.add(InlineKeyboardButton(I18N[u["lang"]]["btn_admin"], callback_data="m:admin"))
-    return kb
+    return MENUS[(user_lang(uid), is_admin(uid))]
 
 def safe_edit(chat_id, msg_id, text, reply_markup=None):
     try:
@@ -440,33 +1080,582 @@ def safe_edit(chat_id, msg_id, text, reply_markup=None):
     except Exception:
         bot.send_message(chat_id, text, reply_markup=reply_markup)
 
+# ------------------ THROTTLING ----------------
+# Vor den Handlern: Token-Bucket je (Nutzer, Klasse) und ein globales Limit gleichzeitiger teurer Handler.
+# menu = billige Taps, heavy = Verlauf/Admin-Statistik/CSV, money = Senden/Auszahlen/Escrow inkl. Passwort/2FA.
+def _rate(spec):
+    r, _, b = spec.partition("/")
+    return float(r), int(b or max(1, float(r)))
+
+THROTTLE_CLASSES = {"menu": _rate(THROTTLE_MENU), "heavy": _rate(THROTTLE_HEAVY), "money": _rate(THROTTLE_MONEY)}
+STEP_CLASS = {"guard_pw": "money", "guard_2fa": "money", "send_amount": "money", "wd_amount": "money",
+              "payout_csv": "heavy"}
+
+class Throttle:
+    def __init__(self, classes, heavy_slots, users, warn_every):
+        self.classes = classes
+        self.buckets = LRUCache(users * len(classes))     # ohne TTL: sonst gäbe es nach Ablauf wieder vollen Vorrat
+        self.warned = LRUCache(users, warn_every)
+        self.heavy = threading.BoundedSemaphore(max(1, heavy_slots))
+        self.stats = {c: {"ok": 0, "limited": 0, "busy": 0} for c in classes}
+        self.lock = threading.Lock()   # Zähler werden aus allen Shard-Workern erhöht
+
+    def count(self, cls, what):
+        with self.lock: self.stats[cls][what] += 1
+
+    def snapshot(self):
+        with self.lock: return {c: dict(v) for c, v in self.stats.items()}
+
+    def allow(self, uid, cls):
+        rate, burst = self.classes[cls]
+        b = self.buckets.get((uid, cls))
+        if b is None:
+            b = TokenBucket(rate, burst); self.buckets.put((uid, cls), b)
+        return b.try_take()
+
+    def reject(self, u, uid, cls, why):
+        """Gedrosseltes Update verwerfen; Hinweis höchstens alle warn_every Sekunden je Nutzer."""
+        self.count(cls, why)
+        if self.warned.get(uid): return
+        self.warned.put(uid, True)
+        txt = T(uid, "throttled" if why == "limited" else "busy")
+        if isinstance(u, telebot.types.Message):
+            notify(u.chat.id, txt, prio=PRIO_MENU, coalesce="throttle", mode="replace")
+        else:   # Callback: kurzer Toast statt Chat-Nachricht
+            try: bot.answer_callback_query(u.id, txt)
+            except Exception: pass
+
+throttle = Throttle(THROTTLE_CLASSES, THROTTLE_HEAVY_SLOTS, THROTTLE_USERS, THROTTLE_WARN_SECONDS)
+
+def throttled(classify):
+    """classify(update) → (uid, Klasse). Aufrufe aus einem laufenden Handler (request_scope aktiv) zählen nicht."""
+    def deco(fn):
+        @functools.wraps(fn)
+        def wrap(u):
+            if getattr(_req, "users", None) is not None: return fn(u)
+            uid, cls = classify(u)
+            if not throttle.allow(uid, cls):
+                throttle.reject(u, uid, cls, "limited"); return
+            if cls != "heavy":
+                throttle.count(cls, "ok")
+                return fn(u)
+            if not throttle.heavy.acquire(timeout=THROTTLE_HEAVY_WAIT):
+                throttle.reject(u, uid, cls, "busy"); return
+            throttle.count(cls, "ok")
+            try: return fn(u)
+            finally: throttle.heavy.release()
+        return wrap
+    return deco
+
+def cb_class(c):
+    d = c.data or ""
+    if d in ("m:hist", "m:admin") or d.startswith(("hist:", "admin:stats:")): return c.from_user.id, "heavy"
+    if d in ("m:send", "m:wd") or d.startswith(("send:", "esc:")): return c.from_user.id, "money"
+    return c.from_user.id, "menu"
+
+def msg_class(m):
+    hit = conv.data.get(m.chat.id)
+    return m.from_user.id, (STEP_CLASS.get(hit[0], "menu") if hit else "menu")
+
+# ------------------ CONVERSATIONS ----------------
+# Mehrstufige Dialoge als benannte Schritte (statt Closures in telebots Next-Step-Dict, die bei
+# abgebrochenen Flows nie freigegeben werden): je Chat höchstens ein offener Schritt mit JSON-Daten.
+STEPS = {}      # name → (fn(m, **data), ttl, persist)
+GUARDED = {}    # name → fn(chat_id, uid, **data), läuft nach Passwort/2FA (guard)
+
+def step(name, ttl=None, persist=True):
+    """fn(m, **data) als Dialogschritt registrieren. persist=False: nur im RAM (z.B. Klartext-Passwort)."""
+    def deco(fn):
+        STEPS[name] = (fn, ttl or CONV_TTL, persist)
+        return fn
+    return deco
+
+def guarded(name):
+    def deco(fn):
+        GUARDED[name] = fn
+        return fn
+    return deco
+
+class ConvStore:
+    """chat_id → (Schritt, Daten, Ablauf in ms). LRU-begrenzt auf maxsize; Abgelaufenes wird beim Zugriff
+    bzw. spätestens alle sweep Sekunden entfernt. persist: Schreiben nach conv_state, load() nach Neustart."""
+    def __init__(self, maxsize, persist, sweep=60):
+        self.maxsize, self.persist, self.sweep = maxsize, persist, sweep
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.next_sweep = 0
+
+    def load(self):
+        if not self.persist: return
+        conn.execute("DELETE FROM conv_state WHERE expires_ts<=?", (now_ms(),))
+        rows = conn.execute("SELECT chat_id, state, data, expires_ts FROM conv_state ORDER BY expires_ts").fetchall()
+        with self.lock:
+            for r in rows:
+                if r["state"] in STEPS:
+                    self.data[r["chat_id"]] = (r["state"], json.loads(r["data"] or "{}"), r["expires_ts"])
+            gone = self._trim(now_ms())
+        self._forget(gone)
+
+    def _trim(self, now):
+        """Abgelaufene (gedrosselt) und überzählige Einträge entfernen → entfernte chat_ids."""
+        gone = []
+        if now >= self.next_sweep:
+            gone = [k for k, v in self.data.items() if v[2] <= now]
+            for k in gone: del self.data[k]
+            self.next_sweep = now + self.sweep * 1000
+        while len(self.data) > self.maxsize:
+            gone.append(self.data.popitem(last=False)[0])
+        return gone
+
+    def _forget(self, chat_ids):
+        if self.persist and chat_ids:
+            conn.executemany("DELETE FROM conv_state WHERE chat_id=?", [(k,) for k in chat_ids])
+
+    def put(self, chat_id, state, data):
+        _, ttl, persist = STEPS[state]
+        now = now_ms(); exp = now + ttl * 1000
+        with self.lock:
+            self.data[chat_id] = (state, data, exp)
+            self.data.move_to_end(chat_id)
+            gone = self._trim(now)
+        if self.persist and persist:
+            conn.execute("INSERT OR REPLACE INTO conv_state(chat_id,state,data,expires_ts) VALUES(?,?,?,?)",
+                         (chat_id, state, json.dumps(data), exp))
+        elif self.persist:
+            gone.append(chat_id)    # sonst lebt ein älterer Schritt dieses Chats nach Neustart wieder auf
+        self._forget(gone)
+
+    def take(self, chat_id):
+        """Offenen Schritt entnehmen → (state, data, noch_gültig) oder None."""
+        with self.lock:
+            hit = self.data.pop(chat_id, None)
+        if hit is None: return None
+        self._forget([chat_id])
+        return hit[0], hit[1], hit[2] > now_ms()
+
+    def __contains__(self, chat_id):
+        return chat_id in self.data
+
+    def __len__(self):
+        return len(self.data)
+
+conv = ConvStore(CONV_MAX, CONV_PERSIST)
+
+def next_step(chat_id, state, **data):
+    """Nächste Nachricht in chat_id geht an Schritt state (data muss JSON-fähig sein)."""
+    conv.put(chat_id, state, data)
+
+def _conv_match(m):
+    if m.chat.id not in conv: return False
+    if (m.text or "").startswith("/"):     # Befehl bricht den offenen Dialog ab
+        conv.take(m.chat.id); return False
+    return True
+
+@bot.message_handler(func=_conv_match, content_types=["text","photo","document","sticker","video","audio","voice"])
+@throttled(msg_class)
+@per_update
+def on_step(m):
+    hit = conv.take(m.chat.id)
+    if not hit: return
+    state, data, alive = hit
+    if not alive:
+        bot.reply_to(m, T(m.from_user.id,"step_expired"), reply_markup=menu(m.from_user.id)); return
+    STEPS[state][0](m, **data)
+
+# --- Sicherheitsabfragen vor Geldbewegungen: Passwort → 2FA-Code → GUARDED[action] ---
+def guard(chat_id, uid, action, data, pw_ok=False):
+    if not pw_ok and user_has_password(uid):
+        bot.send_message(chat_id, T(uid,"pw_ask"))
+        next_step(chat_id, "guard_pw", uid=uid, action=action, data=data); return
+    if get_user(uid)["twofa_enabled"]:
+        code = "".join(secrets.choice(string.digits) for _ in range(6))
+        next_step(chat_id, "guard_2fa", uid=uid, action=action, data=data, code=code)
+        notify(chat_id, T(uid,"twofa_code", code=code, min=max(1, TWOFA_CODE_TTL // 60))); return
+    GUARDED[action](chat_id, uid, **data)
+
+@step("guard_pw")
+def guard_pw(m, uid, action, data):
+    if not verify_password(uid, m.text or ""):
+        bot.reply_to(m, T(uid,"pw_wrong")); return
+    guard(m.chat.id, uid, action, data, pw_ok=True)
+
+@step("guard_2fa", ttl=TWOFA_CODE_TTL)
+def guard_2fa(m, uid, action, data, code):
+    if not secrets.compare_digest((m.text or "").strip(), code):
+        bot.reply_to(m, "Falscher Code."); return
+    GUARDED[action](m.chat.id, uid, **data)
+
 # ------------------ RPC helper ----------------
-def rpc_post(method, params):
-    tries=0; delay=0.8
-    while True:
-        r = sess.post(SOL_RPC_URL, json={"jsonrpc":"2.0","id":1,"method":method,"params":params}, timeout=25)
+class TokenBucket:
+    """Rate-Limiter (einer pro RPC-Endpoint, prozessweit geteilt): rate Tokens/s, max. burst auf Vorrat.
+    pause() sperrt alle Nutzer bis Ablauf (z. B. bei Retry-After)."""
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.cap = float(burst or max(1.0, self.rate))
+        self.tokens = self.cap
+        self.ts = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def take(self, n=1):
+        """n Tokens (z. B. ein Batch mit n Calls). n > burst wird nicht gekappt: der Bucket geht ins Minus,
+        und die folgenden take() warten die Schuld ab – im Mittel bleibt es bei rate Calls/s."""
+        if self.rate <= 0: return
+        n = float(n); need = min(n, self.cap)
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.cap, self.tokens + (now - self.ts) * self.rate); self.ts = now
+                if now < self.blocked_until:
+                    wait = self.blocked_until - now
+                elif self.tokens >= need:
+                    self.tokens -= n; return
+                else:
+                    wait = (need - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def try_take(self, n=1):
+        """Nicht blockierend: True, wenn n Tokens verfügbar waren."""
+        if self.rate <= 0: return True
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.cap, self.tokens + (now - self.ts) * self.rate); self.ts = now
+            if now < self.blocked_until or self.tokens < n: return False
+            self.tokens -= n; return True
+
+    def pause(self, seconds):
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+            self.tokens = 0.0
+
+class RpcRateLimited(requests.HTTPError):
+    def __init__(self, ep, retry_after=None):
+        super().__init__("429 Too Many Requests")
+        self.ep = ep; self.retry_after = retry_after
+
+class RpcEndpoint:
+    """Ein RPC-Provider mit eigenem Rate-Limit und Health-Daten (Latenz, Fehlerquote, Auswurf)."""
+    def __init__(self, url):
+        self.url = url
+        self.bucket = TokenBucket(RPC_RPS)
+        self.lat = deque(maxlen=200)
+        self.ewma = None; self.err_rate = 0.0
+        self.fails = 0; self.ejected_until = 0.0; self.cooldown = RPC_EJECT_SECONDS
+        self.lock = threading.Lock()
+        self._client = None
+
+    def record(self, ok, dt=None):
+        with self.lock:
+            self.err_rate = 0.9*self.err_rate + (0.0 if ok else 0.1)
+            if ok:
+                self.lat.append(dt)
+                self.ewma = dt if self.ewma is None else 0.8*self.ewma + 0.2*dt
+                self.fails = 0; self.cooldown = RPC_EJECT_SECONDS
+                return
+            self.fails += 1
+            now = time.monotonic()
+            if self.fails >= RPC_EJECT_AFTER and now >= self.ejected_until:
+                # nach Ablauf wieder zugelassen; scheitert der nächste Versuch, gleich wieder raus
+                self.ejected_until = now + self.cooldown
+                self.cooldown = min(self.cooldown*2, 600)
+                print(f"RPC-Endpoint pausiert ({self.ejected_until-now:.0f}s): {self.url}")
+
+    def healthy(self, now=None):
+        return (now or time.monotonic()) >= self.ejected_until
+
+    def weight(self):
+        return (1.0 / max(self.ewma if self.ewma is not None else 0.5, 0.01)) * max(0.05, 1.0 - self.err_rate)
+
+    def p95(self):
+        with self.lock: xs = sorted(self.lat)
+        if len(xs) < 20: return 1.0
+        return max(0.05, xs[int(len(xs)*0.95) - 1])
+
+    def client(self):
+        if self._client is None: self._client = Client(self.url)
+        return self._client
+
+class RpcPool:
+    def __init__(self, urls):
+        self.endpoints = [RpcEndpoint(u) for u in urls]
+        self._send_ep = None
+
+    def pick(self, avoid=None):
+        """Gewichtete Zufallswahl unter gesunden Endpoints (schnell + wenig Fehler = öfter)."""
+        now = time.monotonic()
+        live = [e for e in self.endpoints if e.healthy(now)]
+        if not live:
+            return min(self.endpoints, key=lambda e: e.ejected_until)
+        pref = [e for e in live if e is not avoid and e.bucket.blocked_until <= now] or live
+        return random.choices(pref, weights=[e.weight() for e in pref])[0]
+
+    def best(self):
+        """Endpoint für Sends: bleibt beim bisherigen, solange er gesund und nicht deutlich schlechter ist."""
+        live = [e for e in self.endpoints if e.healthy()] or self.endpoints
+        top = max(live, key=lambda e: e.weight())
+        cur = self._send_ep
+        if cur is None or cur not in live or cur.weight() < 0.5*top.weight():
+            self._send_ep = top
+        return self._send_ep
+
+    def stats(self):
+        return [{"url": e.url, "ewma_ms": round((e.ewma or 0)*1000), "p95_ms": round(e.p95()*1000),
+                 "err_rate": round(e.err_rate, 3), "healthy": e.healthy()} for e in self.endpoints]
+
+rpc_pool = RpcPool(SOL_RPC_URLS)
+
+def _retry_after(r):
+    try: return max(0.0, float(r.headers.get("Retry-After")))
+    except (TypeError, ValueError): return None
+
+def _http_post(ep, body, n=1):
+    """Ein Request an ep (Rate-Limit + Health-Messung). Rückgabe (ep, json)."""
+    ep.bucket.take(n)
+    t0 = time.monotonic()
+    try:
+        r = sess.post(ep.url, json=body, timeout=25)
         if r.status_code==429:
+            raise RpcRateLimited(ep, _retry_after(r))
+        r.raise_for_status()
+        j = r.json()
+    except Exception:
+        ep.record(False); raise
+    ep.record(True, time.monotonic() - t0)
+    return ep, j
+
+_hedge_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="rpc-hedge")
+
+def _hedged_post(ep, body):
+    """Zweiter Request an einen anderen Endpoint, wenn ep nach seiner p95-Latenz nicht geantwortet hat."""
+    f1 = _hedge_pool.submit(_http_post, ep, body)
+    try:
+        return f1.result(timeout=ep.p95())
+    except FuturesTimeout:
+        pass
+    ep2 = rpc_pool.pick(avoid=ep)
+    if ep2 is ep: return f1.result()
+    f2 = _hedge_pool.submit(_http_post, ep2, body)
+    err = None
+    for f in as_completed((f1, f2)):
+        try: return f.result()
+        except Exception as e: err = e
+    raise err
+
+HEDGE_METHODS = {"getTransaction", "getSignaturesForAddress"}
+
+def rpc_post(method, params, hedge=None):
+    body = {"jsonrpc":"2.0","id":1,"method":method,"params":params}
+    if hedge is None: hedge = RPC_HEDGE and method in HEDGE_METHODS
+    tries=0; delay=0.8; last=None
+    while True:
+        ep = rpc_pool.pick(avoid=last)
+        try:
+            ep, j = _hedged_post(ep, body) if hedge and len(rpc_pool.endpoints)>1 else _http_post(ep, body)
+        except RpcRateLimited as e:
             tries+=1
             if tries>6: raise requests.HTTPError("429 Too Many Requests")
-            time.sleep(min(delay,5)); delay*=1.6; continue
-        r.raise_for_status()
-        j=r.json()
+            e.ep.bucket.pause(min(e.retry_after or delay, 30)); delay*=1.6; last=e.ep; continue
+        except (requests.ConnectionError, requests.Timeout, requests.HTTPError):
+            # anderer Endpoint versuchen; mit nur einem Endpoint wie bisher direkt raus
+            tries+=1
+            if tries>6 or len(rpc_pool.endpoints)<2: raise
+            last=ep; continue
         if "error" in j:
             if j["error"].get("code") in (-32005,):
                 tries+=1
                 if tries>6: raise RuntimeError(j["error"])
-                time.sleep(min(delay,5)); delay*=1.6; continue
+                ep.bucket.pause(min(delay,5)); delay*=1.6; last=ep; continue
             raise RuntimeError(j["error"])
         return j["result"]
 
-def get_sigs_for(addr, limit=50):
-    return rpc_post("getSignaturesForAddress", [addr, {"limit": limit}]) or []
+def rpc_batch(calls, max_batch=None):
+    """Mehrere Calls [(method, params), ...] als JSON-RPC-Array (max. max_batch pro Request).
+    Rückgabe in Reihenfolge von calls; pro Eintrag das Ergebnis oder eine Exception."""
+    max_batch = max(1, max_batch or RPC_BATCH_MAX)
+    out = [None]*len(calls)
+    for off in range(0, len(calls), max_batch):
+        _rpc_batch_chunk(calls[off:off+max_batch], out, off)
+    return out
+
+def _rpc_batch_chunk(calls, out, off):
+    todo = list(range(len(calls)))
+    tries=0; delay=0.8; last=None
+    while todo:
+        body = [{"jsonrpc":"2.0","id":i,"method":calls[i][0],"params":calls[i][1]} for i in todo]
+        ep = rpc_pool.pick(avoid=last)
+        try:
+            ep, j = _http_post(ep, body, n=len(body))   # Provider zählen jeden Call im Batch
+        except RpcRateLimited as e:
+            tries+=1
+            if tries>6: raise requests.HTTPError("429 Too Many Requests")
+            e.ep.bucket.pause(min(e.retry_after or delay, 30)); delay*=1.6; last=e.ep; continue
+        except (requests.ConnectionError, requests.Timeout, requests.HTTPError):
+            tries+=1
+            if tries>6 or len(rpc_pool.endpoints)<2: raise
+            last=ep; continue
+        if not isinstance(j, list):
+            # Provider ohne Batch-Support → einzeln nachholen
+            for i in todo:
+                try: out[off+i] = rpc_post(*calls[i])
+                except Exception as e: out[off+i] = e
+            return
+        by_id = {x.get("id"): x for x in j if isinstance(x, dict)}
+        retry=[]
+        for i in todo:
+            x = by_id.get(i)
+            if x is None or ("error" in x and x["error"].get("code") in (-32005, 429)):
+                retry.append(i); continue
+            out[off+i] = RuntimeError(x["error"]) if "error" in x else x.get("result")
+        if retry:
+            tries+=1
+            if tries>6:
+                for i in retry: out[off+i] = requests.HTTPError("429 Too Many Requests")
+                return
+            ep.bucket.pause(min(delay,5)); delay*=1.6; last=ep
+        todo = retry
+
+def get_sigs_for(addr, limit=50, before=None, until=None):
+    opts = {"limit": limit}
+    if before: opts["before"] = before
+    if until:  opts["until"]  = until
+    return rpc_post("getSignaturesForAddress", [addr, opts]) or []
+
+TX_OPTS = {"encoding":TX_ENCODING,"maxSupportedTransactionVersion":0}   # Auswertung: parse_tx
+
+def get_tx(sig, commitment=None):
+    return rpc_post("getTransaction", [sig, dict(TX_OPTS, commitment=commitment) if commitment else TX_OPTS])
+
+def get_txs(sigs):
+    """getTransaction für viele Signaturen per Batch; Liste aus Tx, None oder Exception."""
+    return rpc_batch([("getTransaction", [sig, TX_OPTS]) for sig in sigs])
+
+_fetch_pool = ThreadPoolExecutor(max_workers=RPC_FETCH_WORKERS, thread_name_prefix="rpc-fetch")
+
+def fetch_txs(sigs):
+    """Lädt Transaktionen mit RPC_FETCH_WORKERS parallelen Batches (gedrosselt über die Endpoint-Buckets).
+    Ergebnis in Reihenfolge von sigs."""
+    chunks = [sigs[i:i+RPC_BATCH_MAX] for i in range(0, len(sigs), RPC_BATCH_MAX)]
+    if len(chunks) <= 1: return get_txs(sigs)
+    out = []
+    for f in [_fetch_pool.submit(get_txs, ch) for ch in chunks]:
+        out.extend(f.result())
+    return out
+
+# ------------------ OUTBOX (ausgehende Nachrichten) ----------------
+PRIO_TX, PRIO_INFO, PRIO_MENU = 0, 1, 2   # Buchungen/Zahlungen vor Admin-/Support-Hinweisen vor Menüs/Infotexten
+TG_MAX_TEXT = 4096
+
+class _OutItem:
+    __slots__ = ("prio", "seq", "method", "payload", "kw", "key", "mode", "tries")
+    def __init__(self, prio, seq, method, payload, kw, key, mode):
+        self.prio, self.seq, self.method, self.payload, self.kw, self.key, self.mode = prio, seq, method, payload, kw, key, mode
+        self.tries = 0
+
+class Outbox:
+    """Ausgehende Telegram-Nachrichten: Aufrufer reihen ein und kehren sofort zurück, Worker senden.
+    - global höchstens OUTBOX_RPS/s (TokenBucket), je Chat Mindestabstand (Gruppen länger)
+    - 429 → Chat für retry_after sperren, Nachricht bleibt vorn; Netzfehler → bis zu 3 Versuche
+    - gleicher coalesce-Schlüssel im selben Chat, solange noch nicht gesendet: 'append' hängt den Text an
+      (mehrere Einzahlungen → eine Nachricht), 'replace' behält nur die neueste (Menü)
+    - versandbereite Chats nach kleinster Priorität, innerhalb eines Chats ebenso"""
+    def __init__(self, rps, chat_interval, group_interval, workers):
+        self.bucket = TokenBucket(rps, burst=rps)
+        self.chat_interval, self.group_interval, self.n_workers = chat_interval, group_interval, workers
+        self.pending = {}        # chat_id → offene _OutItem, sortiert (prio, seq)
+        self.next_at = {}        # chat_id → frühester nächster Versand (monotonic)
+        self.timed = []          # Heap (ready_at, seq, chat_id): Chats mit offenen Nachrichten
+        self.ready = []          # Heap (prio, seq, chat_id): versandbereite Chats
+        self.active = set()      # chat_ids in timed/ready oder gerade beim Worker (genau einmal)
+        self.cv = threading.Condition()
+        self.seq = itertools.count()
+        self.workers = None
+        self.stats = {"sent": 0, "coalesced": 0, "retried": 0, "dropped": 0}
+
+    def _ensure_workers(self):
+        if self.workers is None:
+            with self.cv:
+                if self.workers is None:
+                    self.workers = [threading.Thread(target=self._worker, name=f"outbox-{i}", daemon=True) for i in range(self.n_workers)]
+                    for t in self.workers: t.start()
+
+    def put(self, chat_id, payload, method="send_message", prio=PRIO_TX, coalesce=None, mode="append", **kw):
+        self._ensure_workers()
+        with self.cv:
+            items = self.pending.setdefault(chat_id, [])
+            if coalesce:
+                for it in items:
+                    if it.key != coalesce: continue
+                    if mode == "replace":
+                        it.payload, it.kw = payload, kw; self.stats["coalesced"] += 1; return
+                    if len(it.payload) + len(payload) + 2 <= TG_MAX_TEXT:
+                        it.payload += "\n\n" + payload; it.prio = min(it.prio, prio)
+                        items.sort(key=lambda i: (i.prio, i.seq)); self.stats["coalesced"] += 1; return
+            items.append(_OutItem(prio, next(self.seq), method, payload, kw, coalesce, mode))
+            items.sort(key=lambda i: (i.prio, i.seq))
+            if chat_id not in self.active:
+                self.active.add(chat_id)
+                heapq.heappush(self.timed, (self.next_at.get(chat_id, 0.0), next(self.seq), chat_id))
+                self.cv.notify()
+
+    def _take(self):
+        with self.cv:
+            while True:
+                now = time.monotonic()
+                while self.timed and self.timed[0][0] <= now:
+                    _, _, chat = heapq.heappop(self.timed)
+                    heapq.heappush(self.ready, (self.pending[chat][0].prio, next(self.seq), chat))
+                if self.ready:
+                    _, _, chat = heapq.heappop(self.ready)
+                    return chat, self.pending[chat].pop(0)
+                self.cv.wait(self.timed[0][0] - now if self.timed else None)
+
+    def _done(self, chat, what, retry=None):
+        with self.cv:   # Zähler unter derselben Sperre wie put()/snapshot()
+            self.stats[what] += 1
+            items = self.pending.get(chat, [])
+            if retry: items.insert(0, retry)
+            if items:
+                heapq.heappush(self.timed, (self.next_at.get(chat, 0.0), next(self.seq), chat)); self.cv.notify()
+            else:
+                self.pending.pop(chat, None); self.active.discard(chat)
+                if self.next_at.get(chat, 0.0) <= time.monotonic(): self.next_at.pop(chat, None)
 
-def get_tx(sig):
-    return rpc_post("getTransaction", [sig, {"encoding":"jsonParsed","maxSupportedTransactionVersion":0}])
+    def snapshot(self):
+        with self.cv: return dict(self.stats)
+
+    def _worker(self):
+        while True:
+            chat, it = self._take()
+            self.bucket.take()
+            retry = None; what = "sent"
+            try:
+                if hasattr(it.payload, "seek"): it.payload.seek(0)
+                getattr(bot, it.method)(chat, it.payload, **it.kw)
+                self.next_at[chat] = time.monotonic() + (self.group_interval if chat < 0 else self.chat_interval)
+            except ApiTelegramException as e:
+                if e.error_code == 429:
+                    wait = float(((e.result_json or {}).get("parameters") or {}).get("retry_after", 1))
+                    self.next_at[chat] = time.monotonic() + wait; retry = it; what = "retried"
+                else:   # 400/403 (blockiert, Chat weg) → verwerfen
+                    print("Outbox verworfen:", chat, e); what = "dropped"
+            except Exception as e:
+                it.tries += 1
+                if it.tries < 3:
+                    self.next_at[chat] = time.monotonic() + 2 ** it.tries; retry = it; what = "retried"
+                else:
+                    print("Outbox verworfen:", chat, e); what = "dropped"
+            self._done(chat, what, retry)
+
+outbox = Outbox(OUTBOX_RPS, OUTBOX_CHAT_INTERVAL, OUTBOX_GROUP_INTERVAL, OUTBOX_WORKERS)
+
+def notify(chat_id, text, prio=PRIO_TX, coalesce=None, mode="append", **kw):
+    """Nachricht einreihen (nicht blockierend); kw wie bot.send_message (reply_markup, ...)."""
+    outbox.put(chat_id, text, prio=prio, coalesce=coalesce, mode=mode, **kw)
 
 # ------------------ Commands ------------------
 @bot.message_handler(commands=["start"])
+@throttled(msg_class)
+@per_update
 def start(m):
     ref_by=None
     if m.text and len(m.text.split())>1:
@@ -477,6 +1666,8 @@ def start(m):
     bot.reply_to(m, T(m.from_user.id,"welcome"), reply_markup=menu(m.from_user.id))
 
 @bot.message_handler(commands=["menu"])
+@throttled(msg_class)
+@per_update
 def cmd_menu(m):
     ensure_user(m.from_user)
     bot.reply_to(m, T(m.from_user.id,"menu"), reply_markup=menu(m.from_user.id))
@@ -485,118 +1676,427 @@ def cmd_menu(m):
 def is_valid_pubkey(addr:str)->bool:
     return bool(re.fullmatch(r"[1-9A-HJ-NP-Za-km-z]{32,44}", addr or ""))
 
-def on_deposit_source(uid, m):
+class SourceIndex:
+    """Im Speicher gehaltener Index source_addr → {user_id} für den Scanner.
+    Wird einmal geladen, add() schreibt durch; refresh() lädt nur neu, wenn der
+    Zähler in counters nicht zur eigenen Version passt (Änderung von außen)."""
+    def __init__(self):
+        self.by_addr = {}
+        self.version = None
+        self.lock = threading.Lock()
+
+    def _db_version(self):
+        r = conn.execute("SELECT value FROM counters WHERE name='expected_sources'").fetchone()
+        return r["value"] if r else 0
+
+    def load(self):
+        v = self._db_version()
+        m = {}
+        for r in conn.execute("SELECT user_id, source_addr FROM expected_sources"):
+            m.setdefault(r["source_addr"], set()).add(r["user_id"])
+        with self.lock:
+            self.by_addr = {a: frozenset(u) for a, u in m.items()}
+            self.version = v
+
+    def refresh(self):
+        if self.version is None or self._db_version() != self.version:
+            self.load()
+        return self
+
+    def add(self, uid, addr):
+        v0 = self._db_version()
+        cur = conn.execute("INSERT OR IGNORE INTO expected_sources(user_id,source_addr,created_at) VALUES(?,?,?)",
+                           (uid, addr, now_iso()))
+        conn.commit()
+        v1 = self._db_version()
+        with self.lock:
+            self.by_addr[addr] = self.by_addr.get(addr, frozenset()) | {uid}
+            # nur die eigene Änderung dazwischen → Version übernehmen, sonst beim nächsten refresh() neu laden
+            self.version = v1 if self.version == v0 and v1 == v0 + max(cur.rowcount, 0) else None
+
+    def get(self, addr, default=frozenset()):
+        return self.by_addr.get(addr, default)
+
+    def __contains__(self, addr):
+        return addr in self.by_addr
+
+    def __len__(self):
+        return len(self.by_addr)
+
+source_index = SourceIndex()
+
+@step("deposit_source")
+def on_deposit_source(m, uid):
     src = (m.text or "").strip()
     if not is_valid_pubkey(src):
         bot.reply_to(m, T(uid,"err_src")); return
-    conn.execute("INSERT OR IGNORE INTO expected_sources(user_id,source_addr,created_at) VALUES(?,?,?)",
-                 (uid, src, now_iso()))
-    conn.commit()
+    source_index.add(uid, src)
     bot.reply_to(m, T(uid,"deposit_source_ok", src=src, addr=CENTRAL_WALLET_ADDRESS, min=f"{MIN_DEPOSIT_SOL} SOL"),
                  reply_markup=menu(uid))
 
-def credit_deposit(uid, sol_amt, sig):
-    bal_adj(uid, "SOL", da=Decimal(sol_amt))
-    conn.execute("INSERT INTO tx_log(id,type,user_from,user_to,asset,amount,fee,chain_sig,meta,created_at) VALUES(?,?,?,?,?,?,?,?,?,?)",
-                 (str(uuid.uuid4()),"deposit",uid,None,"SOL",float(sol_amt),0,str(sig),"{}",now_iso()))
+def credit_deposit(uid, sol_amt, sig, announce=True):
+    with ledger_tx():
+        bal_adj(uid, "SOL", da=Decimal(sol_amt))
+        tx_log_add("deposit", uid, None, "SOL", sol_amt, chain_sig=str(sig))
+    if announce: notify_deposit(uid, sol_amt, sig)
+
+def notify_deposit(uid, sol_amt, sig):
+    notify(uid, T(uid,"deposit_booked", amt=fnum(sol_amt), sig=sig), coalesce="deposit")
+
+# --- Tx-Parser ---
+# getTransaction-Ergebnis einmal dekodieren → TxRecord(slot, sig, transfers): System-Transfers auf wallet als
+# (Quelle, Lamports), aus Top-Level- und inneren Instruktionen (CPI), bei v0 inkl. Adressen aus Lookup-Tables.
+SYSTEM_PROGRAM = "11111111111111111111111111111111"
+SYS_TRANSFER = 2                                  # SystemInstruction::Transfer: u32 LE Tag + u64 LE Lamports
+MIN_DEPOSIT_LAMPORTS = to_units("SOL", MIN_DEPOSIT_SOL)
+
+class TxRecord:
+    __slots__ = ("slot", "sig", "transfers")
+    def __init__(self, slot, sig, transfers):
+        self.slot, self.sig, self.transfers = slot, sig, transfers
+
+def _shortvec(b, i):
+    n = s = 0
+    while True:
+        x = b[i]; i += 1
+        n |= (x & 0x7f) << s; s += 7
+        if x < 0x80: return n, i
+
+def _decode_wire(raw):
+    """Tx im Wire-Format (legacy oder v0) → (statische Account-Keys, [(programIdIndex, accounts, data)]).
+    Lookup-Tables der Nachricht werden übersprungen – die aufgelösten Adressen stehen in meta.loadedAddresses."""
+    n, i = _shortvec(raw, 0); i += 64 * n        # Signaturen
+    if raw[i] & 0x80: i += 1                     # Versions-Präfix
+    i += 3                                       # Header
+    n, i = _shortvec(raw, i)
+    keys = [b58encode(raw[j:j+32]).decode() for j in range(i, i + 32*n, 32)]
+    i += 32*n + 32                               # + recent blockhash
+    n, i = _shortvec(raw, i); ixs = []
+    for _ in range(n):
+        prog = raw[i]; i += 1
+        k, i = _shortvec(raw, i); acc = raw[i:i+k]; i += k
+        k, i = _shortvec(raw, i); ixs.append((prog, acc, raw[i:i+k])); i += k
+    return keys, ixs
+
+def parse_tx(tx, wallet, sig=None):
+    """Versteht encoding base64, json und jsonParsed. Fehlgeschlagene Tx (meta.err) haben keine Transfers."""
+    meta = tx.get("meta") or {}
+    rec = TxRecord(tx.get("slot"), sig, [])
+    if meta.get("err") is not None: return rec
+    t = tx.get("transaction")
+    if isinstance(t, list):                      # base64: [daten, "base64"]
+        keys, ixs = _decode_wire(base64.b64decode(t[0])); listed = False
+    else:
+        msg = t.get("message", {})
+        raw = msg.get("accountKeys", [])
+        keys = [k["pubkey"] if isinstance(k, dict) else k for k in raw]
+        ixs = msg.get("instructions", [])
+        listed = bool(raw) and isinstance(raw[0], dict)    # jsonParsed führt Lookup-Adressen schon in accountKeys
+    loaded = meta.get("loadedAddresses")
+    if loaded and not listed:
+        keys = keys + loaded.get("writable", []) + loaded.get("readonly", [])
+    if wallet not in keys: return rec
+    w = keys.index(wallet)
+    sys_i = keys.index(SYSTEM_PROGRAM) if SYSTEM_PROGRAM in keys else -1
+    inner = (ix for grp in meta.get("innerInstructions") or () for ix in grp.get("instructions", ()))
+    for ix in itertools.chain(ixs, inner):
+        if isinstance(ix, tuple):
+            prog, acc, data = ix
+        elif "parsed" in ix:                     # jsonParsed
+            p = ix["parsed"]
+            if ix.get("program") == "system" and isinstance(p, dict) and p.get("type") == "transfer" \
+               and p["info"].get("destination") == wallet:
+                rec.transfers.append((p["info"]["source"], int(p["info"]["lamports"])))
+            continue
+        elif "programIdIndex" in ix:             # json bzw. innerInstructions (data base58)
+            prog, acc, data = ix["programIdIndex"], ix["accounts"], ix["data"]
+        else:
+            continue
+        if prog != sys_i or len(acc) < 2 or acc[1] != w: continue
+        if isinstance(data, str): data = b58decode(data.encode())
+        if len(data) >= 12 and int.from_bytes(data[:4], "little") == SYS_TRANSFER:
+            rec.transfers.append((keys[acc[0]], int.from_bytes(data[4:12], "little")))
+    return rec
+
+# --- Scanner-Cursor ---
+def cursor_get(name):
+    r = conn.execute("SELECT sig, slot, meta FROM scan_cursor WHERE name=?", (name,)).fetchone()
+    if not r: return None
+    return {"sig": r["sig"], "slot": r["slot"], "meta": json.loads(r["meta"] or "{}")}
+
+def cursor_set(name, sig, slot, meta=None):
+    conn.execute("""INSERT INTO scan_cursor(name,sig,slot,meta,updated_at) VALUES(?,?,?,?,?)
+                    ON CONFLICT(name) DO UPDATE SET sig=excluded.sig, slot=excluded.slot,
+                                                    meta=excluded.meta, updated_at=excluded.updated_at""",
+                 (name, sig, slot, json.dumps(meta or {}), now_iso()))
     conn.commit()
-    try: bot.send_message(uid, T(uid,"deposit_booked", amt=str(sol_amt), sig=sig))
-    except: pass
 
-def is_sol_deposit_from_source(tx_result, source_addr: str, dest_addr: str, min_sol: Decimal):
+def cursor_del(name):
+    conn.execute("DELETE FROM scan_cursor WHERE name=?", (name,)); conn.commit()
+
+def fetch_sigs_since(addr, until_sig=None):
+    """Alle Signaturen neuer als until_sig (älteste zuerst). Ohne Cursor: nur die letzte Seite."""
+    out = []; before = None
+    limit = SCAN_PAGE_LIMIT if until_sig else min(60, SCAN_PAGE_LIMIT)
+    while True:
+        page = get_sigs_for(addr, limit=limit, before=before, until=until_sig)
+        out.extend(page)
+        if not until_sig or len(page) < limit: break
+        before = page[-1].get("signature")
+    out.reverse()
+    return out
+
+class DedupStore:
+    """Bereits verarbeitete Signaturen: RAM-Fenster der letzten Einträge + deposit_seen (mit Slot).
+    Einträge weit unter dem Scanner-Cursor werden gelöscht; gutgeschriebene Signaturen bleiben
+    über tx_log.chain_sig erkennbar, damit ein späterer Backfill nicht doppelt bucht."""
+    def __init__(self, size):
+        self.size = size
+        self.recent = OrderedDict()
+        self.lock = threading.Lock()
+        self.last_prune = 0.0
+
+    def _remember(self, sigs):
+        with self.lock:
+            for sig in sigs:
+                self.recent[sig] = True; self.recent.move_to_end(sig)
+            while len(self.recent) > self.size:
+                self.recent.popitem(last=False)
+
+    def seen_many(self, sigs):
+        """Menge der bereits gesehenen Signaturen aus sigs (eine Query je 400 Signaturen)."""
+        with self.lock:
+            hit = {sig for sig in sigs if sig in self.recent}
+        rest = [sig for sig in sigs if sig not in hit]
+        for off in range(0, len(rest), 400):
+            part = rest[off:off+400]; q = ",".join("?"*len(part))
+            rows = conn.execute(f"""SELECT sig FROM deposit_seen WHERE sig IN ({q})
+                                    UNION SELECT chain_sig FROM tx_log WHERE type='deposit' AND chain_sig IN ({q})""",
+                                part + part).fetchall()
+            found = {r[0] for r in rows}
+            self._remember(found); hit |= found
+        return hit
+
+    def is_seen(self, sig):
+        return bool(self.seen_many([sig]))
+
+    def mark(self, sig, slot=None):
+        with ledger_tx():
+            conn.execute("INSERT OR IGNORE INTO deposit_seen(sig, slot) VALUES(?,?)", (sig, slot))
+        self._remember([sig])
+
+    def prune(self, watermark_slot):
+        """Löscht Einträge unterhalb watermark_slot - DEDUP_KEEP_SLOTS (und Altbestand ohne Slot)."""
+        self.last_prune = time.monotonic()
+        cut = (watermark_slot or 0) - DEDUP_KEEP_SLOTS
+        if cut <= 0: return 0
+        n = conn.execute("DELETE FROM deposit_seen WHERE slot IS NULL OR slot < ?", (cut,)).rowcount
+        conn.commit()
+        return n
+
+deposit_dedup = DedupStore(DEDUP_CACHE_SIZE)
+
+def process_deposit_sig(sig, expected, commitment=None):
+    """Prüft eine Signatur und schreibt ggf. gut. False = RPC-Fehler bzw. Tx (bei commitment)
+    noch nicht abrufbar – später erneut versuchen."""
+    if deposit_dedup.is_seen(sig): return True
+
     try:
-        meta    = tx_result.get("meta", {})
-        txn     = tx_result.get("transaction", {})
-        message = txn.get("message", {})
-        for inst in message.get("instructions", []):
-            if inst.get("program") == "system" and inst.get("parsed", {}).get("type") == "transfer":
-                info = inst["parsed"]["info"]
-                if info.get("source")==source_addr and info.get("destination")==dest_addr:
-                    lamports = int(info.get("lamports", 0))
-                    sol = Decimal(lamports) / Decimal(1_000_000_000)
-                    if sol >= min_sol:
-                        return True, dquant(sol, 9)
-        keys = message.get("accountKeys", [])
-        if source_addr in [k.get("pubkey") if isinstance(k, dict) else k for k in keys] and \
-           dest_addr   in [k.get("pubkey") if isinstance(k, dict) else k for k in keys]:
-            flat = [k.get("pubkey") if isinstance(k, dict) else k for k in keys]
-            i_src = flat.index(source_addr)
-            i_dst = flat.index(dest_addr)
-            pre  = meta.get("preBalances", [])
-            post = meta.get("postBalances", [])
-            if i_src < len(pre) and i_src < len(post) and i_dst < len(pre) and i_dst < len(post):
-                delta_src = (pre[i_src] - post[i_src]) / 1_000_000_000
-                delta_dst = (post[i_dst] - pre[i_dst]) / 1_000_000_000
-                if delta_src > 0 and abs(delta_src - delta_dst) < 1e-9 and delta_dst >= float(min_sol):
-                    return True, dquant(Decimal(delta_dst), 9)
+        tx = get_tx(sig, commitment)   # Backoff/Rate-Limit macht rpc_post
     except Exception:
-        pass
-    return False, Decimal("0")
+        return False
+    if not tx and commitment: return False
+    handle_deposit_tx(sig, tx, expected)
+    return True
+
+_deposit_lock = threading.Lock()   # Scanner- und WS-Thread dürfen nicht doppelt gutschreiben
+
+def handle_deposit_tx(sig, tx, expected, slot=None):
+    """Wertet eine geladene Tx aus, schreibt ggf. gut und markiert die Signatur als gesehen."""
+    with _deposit_lock:
+        if deposit_dedup.is_seen(sig): return
+        if not tx:
+            deposit_dedup.mark(sig, slot)
+            return
+
+        try:
+            rec = parse_tx(tx, CENTRAL_WALLET_ADDRESS, sig)
+        except Exception as e:
+            print("Tx-Parse-Fehler:", sig, e); rec = TxRecord(tx.get("slot"), sig, [])
+        # je registrierter Quelle summieren (mehrere Transfers in einer Tx); erste Quelle ab Mindestbetrag zählt
+        by_src = {}
+        for src, lamports in rec.transfers:
+            if src in expected: by_src[src] = by_src.get(src, 0) + lamports
+        ok_src = next((src for src, n in by_src.items() if n >= MIN_DEPOSIT_LAMPORTS), None)
+        amt_sol = from_units("SOL", by_src[ok_src]) if ok_src else Decimal("0")
+
+        credited = sorted(expected.get(ok_src, [])) if ok_src else []
+        with ledger_tx():   # Gutschrift + Dedup-Eintrag atomar → kein Doppel-Buchen nach Absturz
+            for uid in credited:
+                credit_deposit(uid, amt_sol, sig, announce=False)
+            deposit_dedup.mark(sig, rec.slot or slot)
+        for uid in credited:
+            notify_deposit(uid, amt_sol, sig)
+
+_tx_missing = {}   # sig → monotonic beim ersten "nicht abrufbar" (getTransaction = None)
+
+def _tx_missing_expired(sig):
+    """True, wenn sig schon länger als DEPOSIT_MISSING_SECONDS nicht abrufbar ist."""
+    first = _tx_missing.setdefault(sig, time.monotonic())
+    return time.monotonic() - first > DEPOSIT_MISSING_SECONDS
+
+def process_sig_entries(entries, expected, cursor_name=None):
+    """Verarbeitet Einträge aus getSignaturesForAddress in gegebener Reihenfolge.
+    Transaktionen werden fensterweise parallel geladen (fetch_txs), verarbeitet wird in Slot-Reihenfolge.
+    Mit cursor_name wird der Cursor je Fenster einmal (auf die letzte verarbeitete Signatur) weitergeschoben;
+    stoppt beim ersten RPC-Fehler oder einer noch nicht abrufbaren Tx (Endpoint hinter dem, der die
+    Signaturen geliefert hat); letztere wird nach DEPOSIT_MISSING_SECONDS als gesehen markiert. Bereits Verarbeitetes vor dem Cursor fängt nach Absturz die Dedup ab."""
+    window = RPC_BATCH_MAX * RPC_FETCH_WORKERS
+    for off in range(0, len(entries), window):
+        chunk = entries[off:off+window]
+        # fehlgeschlagene Tx (err) gar nicht erst laden: Instruktionen wurden nie ausgeführt
+        cand = [s.get("signature") or s.get("sig") for s in chunk if s.get("err") is None]
+        cand = [sig for sig in cand if sig]
+        seen = deposit_dedup.seen_many(cand)
+        need = [sig for sig in cand if sig not in seen]
+        txs = dict(zip(need, fetch_txs(need))) if need else {}
+        last = None; ok = True
+        for s in chunk:
+            sig = s.get("signature") or s.get("sig")
+            if not sig: continue
+            if sig in txs:
+                # None: Endpoint kennt die (gelistete, erfolgreiche) Tx noch nicht → wie RPC-Fehler später erneut,
+                # nicht als gesehen markieren und den Cursor davor stehen lassen – aber nur begrenzt lange,
+                # sonst blockiert eine nie abrufbare Tx Scanner und Backfill dauerhaft
+                if isinstance(txs[sig], Exception):
+                    ok = False; break
+                if txs[sig] is None:
+                    if not _tx_missing_expired(sig):
+                        ok = False; break
+                    print(f"Tx seit {DEPOSIT_MISSING_SECONDS:.0f}s nicht abrufbar, übersprungen:", sig)
+                _tx_missing.pop(sig, None)
+                handle_deposit_tx(sig, txs[sig], expected, s.get("slot"))
+            last = s
+        if cursor_name and last:
+            cursor_set(cursor_name, last.get("signature") or last.get("sig"), last.get("slot"))
+        if not ok: return False
+    return True
+
+def scan_deposits_once():
+    cur = cursor_get("deposit")
+    sigs = fetch_sigs_since(CENTRAL_WALLET_ADDRESS, until_sig=(cur["sig"] if cur else None))
+    if not sigs: return 0
+    process_sig_entries(sigs, source_index.refresh(), cursor_name="deposit")
+    if time.monotonic() - deposit_dedup.last_prune > DEDUP_PRUNE_SECONDS:
+        cur = cursor_get("deposit")
+        if cur and cur["slot"]: deposit_dedup.prune(cur["slot"])
+    return len(sigs)
+
+scan_wakeup  = threading.Event()   # sofortiger Cursor-Poll (z. B. nach WS-Reconnect)
+ws_connected = threading.Event()   # WS-Abo aktiv → Poll nur noch als Sicherheitsnetz
 
 def scan_deposits_loop():
     print("Deposit-Scanner gestartet.")
     while True:
         try:
-            sigs = get_sigs_for(CENTRAL_WALLET_ADDRESS, limit=60)
-            rows = conn.execute("SELECT user_id, source_addr FROM expected_sources").fetchall()
-            expected = {}
-            for r in rows:
-                expected.setdefault(r["source_addr"], set()).add(r["user_id"])
-
-            for s in sigs:
-                sig = s.get("signature") or s.get("sig")
-                if not sig: continue
-                if conn.execute("SELECT 1 FROM deposit_seen WHERE sig=?", (sig,)).fetchone(): continue
-
-                tx = None
-                for attempt in range(5):
-                    try:
-                        tx = get_tx(sig); break
-                    except Exception as e:
-                        if "429" in str(e): time.sleep(0.6*(attempt+1)); continue
-                        tx = None; break
-                if not tx:
-                    conn.execute("INSERT OR IGNORE INTO deposit_seen(sig) VALUES(?)", (sig,)); conn.commit()
-                    continue
-
-                result = tx
-                ok_src = None; amt_sol = Decimal("0")
-                try:
-                    msg = result.get("transaction", {}).get("message", {})
-                    for inst in msg.get("instructions", []):
-                        if inst.get("program")=="system" and inst.get("parsed",{}).get("type")=="transfer":
-                            info=inst["parsed"]["info"]
-                            src = info.get("source"); dst=info.get("destination")
-                            if dst == CENTRAL_WALLET_ADDRESS and src in expected:
-                                ok, a = is_sol_deposit_from_source(result, src, CENTRAL_WALLET_ADDRESS, MIN_DEPOSIT_SOL)
-                                if ok: ok_src = src; amt_sol = a; break
-                except Exception:
-                    pass
-
-                if ok_src:
-                    for uid in expected.get(ok_src, []):
-                        credit_deposit(uid, amt_sol, sig)
-
-                conn.execute("INSERT OR IGNORE INTO deposit_seen(sig) VALUES(?)", (sig,))
-                conn.commit()
-
+            scan_deposits_once()
         except requests.HTTPError:
             time.sleep(3)
         except Exception as e:
             print("Scan-Fehler:", e)
-        time.sleep(DEPOSIT_POLL_SECONDS)
+        scan_wakeup.wait(DEPOSIT_WS_POLL_SECONDS if ws_connected.is_set() else DEPOSIT_POLL_SECONDS)
+        scan_wakeup.clear()
+
+# --- Push-Erkennung über Solana PubSub (logsSubscribe / accountSubscribe) ---
+def on_ws_signature(sig):
+    """Signatur aus logsNotification direkt gutschreiben; klappt es (noch) nicht, holt es der Cursor-Poll."""
+    try:
+        if not process_deposit_sig(sig, source_index.refresh(), commitment="confirmed"):
+            scan_wakeup.set()
+    except Exception as e:
+        print("WS-Deposit-Fehler:", e)
+
+async def _ws_session(url):
+    async with websockets.connect(url, ping_interval=20, ping_timeout=20, max_size=2**22) as ws:
+        if DEPOSIT_WS_MODE == "account":
+            params = [CENTRAL_WALLET_ADDRESS, {"commitment":"confirmed","encoding":"base64"}]
+            await ws.send(json.dumps({"jsonrpc":"2.0","id":1,"method":"accountSubscribe","params":params}))
+        else:
+            params = [{"mentions":[CENTRAL_WALLET_ADDRESS]}, {"commitment":"confirmed"}]
+            await ws.send(json.dumps({"jsonrpc":"2.0","id":1,"method":"logsSubscribe","params":params}))
+        ack = json.loads(await ws.recv())
+        if "error" in ack: raise RuntimeError(ack["error"])
+        ws_connected.set()
+        scan_wakeup.set()   # Lücke seit letztem Poll/Disconnect per Cursor schließen
+        loop = asyncio.get_running_loop()
+        async for raw in ws:
+            msg = json.loads(raw)
+            if msg.get("method") == "logsNotification":
+                v = msg["params"]["result"]["value"]
+                if v.get("err") is None and v.get("signature"):
+                    await loop.run_in_executor(None, on_ws_signature, v["signature"])
+            elif msg.get("method") == "accountNotification":
+                scan_wakeup.set()   # Saldo geändert → Signaturen per Cursor holen
+
+def ws_deposit_loop(url=None):
+    url = url or SOL_WS_URL
+    print(f"Deposit-WS gestartet ({DEPOSIT_WS_MODE}).")
+    delay = 1
+    while True:
+        started = time.monotonic()
+        try:
+            asyncio.run(_ws_session(url))
+        except Exception as e:
+            print("WS-Fehler:", e)
+        finally:
+            ws_connected.clear()
+        if time.monotonic() - started > 60: delay = 1
+        time.sleep(delay); delay = min(delay*2, 30)
+
+def backfill_deposits(to_slot, resume=True):
+    """Geht die Historie der Wallet rückwärts bis to_slot durch (z. B. nach Ausfall).
+    Fortschritt wird als Checkpoint 'backfill' gespeichert und bei resume=True fortgesetzt."""
+    cp = cursor_get("backfill") if resume else None
+    before = cp["sig"] if cp and cp["meta"].get("to_slot") == to_slot else None
+    print(f"Backfill bis Slot {to_slot} gestartet" + (f" (ab {before})" if before else "") + ".")
+    expected = source_index.refresh()
+    done = 0
+    while True:
+        page = get_sigs_for(CENTRAL_WALLET_ADDRESS, limit=SCAN_PAGE_LIMIT, before=before)
+        if not page: break
+        todo = [s for s in page if (s.get("slot") or 0) >= to_slot]
+        if not process_sig_entries(list(reversed(todo)), expected):
+            raise RuntimeError("Backfill unterbrochen (RPC), Checkpoint bleibt erhalten.")
+        done += len(todo)
+        before = page[-1].get("signature")
+        cursor_set("backfill", before, page[-1].get("slot"), {"to_slot": to_slot})
+        if len(todo) < len(page) or len(page) < SCAN_PAGE_LIMIT: break
+    cursor_del("backfill")
+    print(f"Backfill fertig: {done} Signaturen geprüft.")
+    return done
+
+def backfill_loop(to_slot):
+    while True:
+        try:
+            backfill_deposits(to_slot); return
+        except Exception as e:
+            print("Backfill-Fehler:", e)
+            time.sleep(DEPOSIT_POLL_SECONDS)
 
 # ------------------ SEND FLOW -------------------
+@step("send_who")
 def send_who(m):
     u = (m.text or "").strip().lstrip("@")
-    row = get_user_by_username(u)
-    if not row:
+    hit = lookup_username(u)
+    if not hit:
         bot.reply_to(m, f"@{u} nicht gefunden. (Empfänger muss /start ausführen.)"); return
-    if row["user_id"]==m.from_user.id:
+    to_uid, to_uname = hit
+    if to_uid==m.from_user.id:
         bot.reply_to(m, "Du kannst dir selbst nichts senden."); return
-    msg = bot.reply_to(m, T(m.from_user.id,"send_amt", u=row["username"] or row["user_id"]))
-    bot.register_next_step_handler(msg, lambda x: send_amount(x, row["user_id"], row["username"] or str(row["user_id"])))
+    msg = bot.reply_to(m, T(m.from_user.id,"send_amt", u=to_uname))
+    next_step(msg.chat.id, "send_amount", to_uid=to_uid, to_uname=to_uname)
 
+@step("send_amount")
 def send_amount(m, to_uid, to_uname):
     try:
         amt = Decimal((m.text or "").replace(",",".").strip())
@@ -607,129 +2107,230 @@ def send_amount(m, to_uid, to_uname):
     if amt>av:
         bot.reply_to(m, T(m.from_user.id,"err_balance", av=fmt("SOL",av))); return
     kb=InlineKeyboardMarkup()
-    kb.add(InlineKeyboardButton(I18N[get_user(m.from_user.id)["lang"]]["mode_fnf"],
+    kb.add(InlineKeyboardButton(I18N[user_lang(m.from_user.id)]["mode_fnf"],
                                 callback_data=f"send:go:FNF:{to_uid}:{to_uname}:{amt}"))
-    kb.add(InlineKeyboardButton(I18N[get_user(m.from_user.id)["lang"]]["mode_escrow"],
+    kb.add(InlineKeyboardButton(I18N[user_lang(m.from_user.id)]["mode_escrow"],
                                 callback_data=f"send:go:ESCROW:{to_uid}:{to_uname}:{amt}"))
-    bot.reply_to(m, T(m.from_user.id,"send_mode", amt=str(amt)), reply_markup=kb)
-
-def _ask_password_then(fn, *args):
-    """Wenn Passwort aktiv: abfragen; sonst direkt weiter."""
-    chat_id = args[0] if args else None
-    uid = args[1] if len(args)>1 else None
-    if user_has_password(uid):
-        msg = bot.send_message(chat_id, T(uid, "pw_ask"))
-        def check_pw(m):
-            if not verify_password(uid, (m.text or "")):
-                bot.reply_to(m, T(uid,"pw_wrong")); return
-            fn(*args)
-        bot.register_next_step_handler(msg, check_pw)
-    else:
-        fn(*args)
+    bot.reply_to(m, T(m.from_user.id,"send_mode", amt=fnum(amt)), reply_markup=kb)
 
+@guarded("send")
 def do_send(chat_id, from_uid, to_uid, to_uname, amt, mode):
+    amt = Decimal(amt)
     av,_=bal(from_uid, "SOL")
     if amt>av:
-        bot.send_message(chat_id, T(from_uid,"err_balance", av=fmt("SOL",av))); return
+        notify(chat_id, T(from_uid,"err_balance", av=fmt("SOL",av))); return
     fee_percent = FEE_FNF + (FEE_ESCROW_EXTRA if mode=="ESCROW" else Decimal("0"))
     fee = dquant(amt * fee_percent / Decimal("100"), 9)
     net = dquant(amt - fee, 9)
-    bal_adj(from_uid, "SOL", da=-amt)
-    bal_adj(0, "SOL", da=fee)
+    try:
+        with ledger_tx():   # Sender, Gebührenkonto, Empfänger + tx_log: alles oder nichts
+            bal_adj(from_uid, "SOL", da=-amt)
+            bal_adj(0, "SOL", da=fee)
+            if mode=="FNF":
+                bal_adj(to_uid, "SOL", da=net)
+                t_id=tx_log_add("send", from_uid, to_uid, "SOL", net, fee)
+            else:
+                bal_adj(to_uid, "SOL", dh=net)
+                t_id=tx_log_add("escrow_hold", from_uid, to_uid, "SOL", net, fee)
+    except InsufficientBalance:
+        av,_=bal(from_uid, "SOL")
+        notify(chat_id, T(from_uid,"err_balance", av=fmt("SOL",av))); return
+    names = usernames([from_uid, to_uid])
     if mode=="FNF":
-        bal_adj(to_uid, "SOL", da=net)
-        conn.execute("INSERT INTO tx_log VALUES(?,?,?,?,?,?,?,?,?,?)",
-                     (str(uuid.uuid4()),"send",from_uid,to_uid,"SOL",float(net),float(fee),None,"{}",now_iso()))
-        bot.send_message(chat_id, T(from_uid,"sent_fnf_sender", u=(get_username(to_uid)), amt=str(net), fee=str(fee_percent)))
-        bot.send_message(to_uid,   T(to_uid,"sent_fnf_recv",   u=(get_username(from_uid)), amt=str(net)))
+        notify(chat_id, T(from_uid,"sent_fnf_sender", u=names[to_uid], amt=fnum(net), fee=fnum(fee_percent)))
+        notify(to_uid,  T(to_uid,"sent_fnf_recv",   u=names[from_uid], amt=fnum(net)))
     else:
-        bal_adj(to_uid, "SOL", dh=net)
-        t_id=str(uuid.uuid4())
-        conn.execute("INSERT INTO tx_log VALUES(?,?,?,?,?,?,?,?,?,?)",
-                     (t_id,"escrow_hold",from_uid,to_uid,"SOL",float(net),float(fee),None,"{}",now_iso()))
         kb=InlineKeyboardMarkup()
         kb.add(InlineKeyboardButton(T(from_uid,"escrow_btn_release"), callback_data=f"esc:release:{t_id}"),
                InlineKeyboardButton(T(from_uid,"escrow_btn_dispute"), callback_data=f"esc:dispute:{t_id}"))
-        bot.send_message(chat_id, T(from_uid,"escrow_hold_s", u=get_username(to_uid), amt=str(net)), reply_markup=kb)
-        bot.send_message(to_uid, T(to_uid,"escrow_hold_r", u=get_username(from_uid), amt=str(net)))
-    conn.commit()
+        notify(chat_id, T(from_uid,"escrow_hold_s", u=names[to_uid], amt=fnum(net)), reply_markup=kb)
+        notify(to_uid,  T(to_uid,"escrow_hold_r", u=names[from_uid], amt=fnum(net)))
+
+# ------------------ STATS -------------------
+STATS_DAYS_SHOWN = 14   # Tageszeilen im Report (Summen gelten für den ganzen Zeitraum)
+
+def stats_day(days_ago=0):
+    return (datetime.now(timezone.utc) - timedelta(days=days_ago)).strftime("%Y-%m-%d")
+
+def stats_totals():
+    rows = conn.execute(f"SELECT name, value FROM counters WHERE name IN ({','.join('?'*len(STATS_COUNTERS))})", STATS_COUNTERS).fetchall()
+    return {**dict.fromkeys(STATS_COUNTERS, 0), **{r["name"]: r["value"] for r in rows}}
+
+def stats_active_users(days):
+    """Verschiedene aktive Nutzer der letzten days Tage (inkl. heute)."""
+    return conn.execute("SELECT COUNT(*) AS c FROM user_last_active WHERE day>=?", (stats_day(days-1),)).fetchone()["c"]
+
+def stats_report(uid, days):
+    since = stats_day(days-1)
+    by_type = conn.execute("""SELECT type, SUM(n) AS n, SUM(volume) AS v, SUM(fees) AS f FROM stats_daily
+                              WHERE day>=? GROUP BY type ORDER BY type""", (since,)).fetchall()
+    daily = conn.execute("""SELECT d.day, SUM(d.n) AS n, SUM(d.volume) AS v, SUM(d.fees) AS f, COALESCE(a.users,0) AS act
+                            FROM stats_daily d LEFT JOIN stats_daily_active a ON a.day=d.day
+                            WHERE d.day>=? GROUP BY d.day ORDER BY d.day DESC LIMIT ?""", (since, STATS_DAYS_SHOWN)).fetchall()
+    out = [T(uid,"admin_stats_title", days=days, active=stats_active_users(days),
+             fee=fmt_u("SOL", sum(r["f"] for r in by_type)))]
+    out += [f"• {r['type']}: {r['n']}× | {fmt_u('SOL', r['v'])}" for r in by_type]
+    since_ms = int(datetime.strptime(since, "%Y-%m-%d").replace(tzinfo=timezone.utc).timestamp()*1000)
+    lat = conn.execute("""SELECT COUNT(*) AS n, AVG(confirm_ms) AS a, MAX(confirm_ms) AS m FROM withdrawals
+                          WHERE confirmed_ts>=?""", (since_ms,)).fetchone()
+    if lat["n"]:
+        out.append(f"⏱ Auszahlung bis confirmed: Ø {lat['a']/1000:.1f}s, max {lat['m']/1000:.1f}s ({lat['n']})")
+    thr = [f"{c} {v['limited']}+{v['busy']}/{v['ok']+v['limited']+v['busy']}" for c, v in throttle.snapshot().items()]
+    out.append("🚦 Gedrosselt seit Start (Rate+Slots/gesamt): " + ", ".join(thr))
+    if daily:
+        out.append("")
+        out += [f"<code>{r['day']}</code> {r['n']} tx | {fmt_u('SOL', r['v'])} | fee {fmt_u('SOL', r['f'])} | 👤{r['act']}" for r in daily]
+    return "\n".join(out)
+
+# ------------------ HISTORY -------------------
+HISTORY_PAGE = 20
+
+def history_rows(uid, older_than=None, newer_than=None, limit=HISTORY_PAGE):
+    """Keyset-Pagination über (created_ts, id), neueste zuerst. Je Richtung (user_from/user_to)
+    eine Index-Range-Query mit LIMIT → Kosten unabhängig von der Größe von tx_log.
+    Der Empfängername kommt per JOIN mit (to_name), kein Lookup je Zeile."""
+    if newer_than:
+        cond, order, key = "(created_ts, id) > (?, ?)", "ASC", newer_than
+    else:
+        cond, order, key = "(created_ts, id) < (?, ?)", "DESC", (older_than or (2**62, ""))
+    sql = f"""SELECT t.*, ut.username AS to_name FROM (
+                SELECT * FROM (
+                  SELECT * FROM (SELECT * FROM tx_log WHERE user_from=? AND {cond} ORDER BY created_ts {order}, id {order} LIMIT ?)
+                  UNION ALL
+                  SELECT * FROM (SELECT * FROM tx_log WHERE user_to=? AND {cond} ORDER BY created_ts {order}, id {order} LIMIT ?)
+                ) ORDER BY created_ts {order}, id {order} LIMIT ?
+              ) t LEFT JOIN users ut ON ut.user_id=t.user_to
+              ORDER BY t.created_ts {order}, t.id {order}"""
+    rows = conn.execute(sql, (uid, *key, limit, uid, *key, limit, limit)).fetchall()
+    return rows[::-1] if newer_than else rows
+
+def history_page(uid, older_than=None, newer_than=None):
+    rows = history_rows(uid, older_than, newer_than, limit=HISTORY_PAGE+1)
+    if newer_than:
+        has_newer = len(rows) > HISTORY_PAGE; rows = rows[-HISTORY_PAGE:] if has_newer else rows
+        has_older = True
+    else:
+        has_older = len(rows) > HISTORY_PAGE; rows = rows[:HISTORY_PAGE]
+        has_newer = older_than is not None
+    if not rows:
+        return T(uid,"history_none"), menu(uid)
+    out=["🧾 <b>Verlauf</b>"]
+    for r in rows:
+        other = r["to_name"] or str(r["user_to"])
+        meta = json.loads(r["meta"] or "{}")
+        sig = r["chain_sig"] or "-"
+        if r["type"]=="deposit":
+            out.append(f"➕ {fmt_u(r['asset'], r['amount'])} | tx: <code>{sig}</code>")
+        elif r["type"]=="send":
+            out.append(f"📤 {fmt_u(r['asset'], r['amount'])} → @{other} (fee {fnum(from_units(r['asset'], r['fee']))}%)")
+        elif r["type"]=="escrow_hold":
+            out.append(f"🛡️ HOLD {fmt_u(r['asset'], r['amount'])} → @{other} (fee {fnum(from_units(r['asset'], r['fee']))}%)")
+        elif r["type"]=="escrow_release":
+            out.append(f"✅ RELEASE {fmt_u(r['asset'], r['amount'])} → @{other}")
+        elif r["type"]=="withdraw":
+            out.append(f"💸 {fmt_u(r['asset'], r['amount'])} → {meta.get('to','addr')} | tx: <code>{sig}</code>")
+    kb = InlineKeyboardMarkup()
+    nav = []
+    if has_older:
+        nav.append(InlineKeyboardButton(T(uid,"btn_older"), callback_data=f"hist:o:{rows[-1]['created_ts']}:{rows[-1]['id']}"))
+    if has_newer:
+        nav.append(InlineKeyboardButton(T(uid,"btn_newer"), callback_data=f"hist:n:{rows[0]['created_ts']}:{rows[0]['id']}"))
+    if nav: kb.row(*nav)
+    kb.keyboard.extend(menu(uid).keyboard)
+    return "\n".join(out), kb
+
+@step("set_pw")
+def set_pw(m, uid):
+    pw1=(m.text or "")
+    if len(pw1)<4: bot.reply_to(m, T(uid,"pw_short")); return
+    msg=bot.reply_to(m, T(uid,"set_pw_confirm"))
+    next_step(msg.chat.id, "set_pw2", uid=uid, pw1=pw1)
+
+@step("set_pw2", persist=False)
+def set_pw2(m, uid, pw1):
+    pw2=(m.text or "")
+    if pw2!=pw1: bot.reply_to(m, T(uid,"pw_mismatch")); return
+    salt=secrets.token_hex(16)
+    h=_hash_pw(pw1, salt)
+    update_user(uid, pass_enabled=1, pw_hash=h, pw_salt=salt)
+    bot.reply_to(m, T(uid,"set_pw_ok"), reply_markup=menu(uid))
+
+@step("admin_edit")
+def admin_edit(m):
+    if not is_admin(m.from_user.id): return
+    try:
+        parts = (m.text or "").strip().split()
+        uid = int(parts[0]); amount = Decimal(parts[1])
+        # ensure user & asset
+        r = get_user(uid)
+        if not r: raise ValueError("no user")
+        bal_adj(uid, "SOL", da=amount)   # kein Abzug unter 0 (InsufficientBalance → Fehlermeldung)
+        av,_ = bal(uid, "SOL")
+        bot.reply_to(m, T(m.from_user.id,"admin_edit_ok", av=fmt("SOL", av)))
+    except Exception:
+        bot.reply_to(m, T(m.from_user.id,"admin_edit_err"))
 
 # 2FA-Callbacks & Support & Neues im gemeinsamen Handler
 @bot.callback_query_handler(func=lambda c: True)
+@throttled(cb_class)
+@per_update
 def on_cb(c):
     ensure_user(c.from_user)
     data=c.data or ""
 
     if data.startswith("send:go:"):
         _,_,mode,to_uid,to_uname,amt = data.split(":")
-        to_uid=int(to_uid); amt=Decimal(amt)
-        u=get_user(c.from_user.id)
-
-        def proceed_after_pw():
-            if u["twofa_enabled"]:
-                code=''.join(random.choices(string.digits,k=6))
-                bot.answer_callback_query(c.id, f"🔐 Code: {code}")
-                bot.send_message(c.message.chat.id, f"🔐 2FA – antworte mit: <code>{code}</code>")
-                def check_code(m):
-                    if (m.text or "").strip()!=code: bot.reply_to(m,"Falscher Code."); return
-                    do_send(m.chat.id, c.from_user.id, to_uid, to_uname, amt, mode)
-                bot.register_next_step_handler(c.message, check_code)
-            else:
-                do_send(c.message.chat.id, c.from_user.id, to_uid, to_uname, amt, mode)
-
-        _ask_password_then(lambda chat_id, uid, *_: proceed_after_pw(), c.message.chat.id, c.from_user.id)
+        try: bot.answer_callback_query(c.id)   # Spinner sofort beenden; Rückfragen/Ergebnis kommen per Nachricht
+        except Exception: pass
+        guard(c.message.chat.id, c.from_user.id, "send",
+              {"to_uid": int(to_uid), "to_uname": to_uname, "amt": str(Decimal(amt)), "mode": mode})
         return
 
     if data=="m:sup":
         msg=bot.send_message(c.message.chat.id, T(c.from_user.id,"support_prompt"))
-        bot.register_next_step_handler(msg, sup_msg)
+        next_step(msg.chat.id, "sup_msg")
         return
 
     if data=="m:about":
-        bot.send_message(c.message.chat.id, T(c.from_user.id,"about_text"))
+        notify(c.message.chat.id, T(c.from_user.id,"about_text"), prio=PRIO_MENU)
         return
 
     if data=="m:pol":
-        bot.send_message(c.message.chat.id, T(c.from_user.id,"policies_text"))
+        notify(c.message.chat.id, T(c.from_user.id,"policies_text"), prio=PRIO_MENU)
         return
 
     if data=="m:help":
-        bot.send_message(c.message.chat.id, T(c.from_user.id,"help_text"))
+        notify(c.message.chat.id, T(c.from_user.id,"help_text"), prio=PRIO_MENU)
         return
 
     if data=="m:admin" and is_admin(c.from_user.id):
-        # Stats
-        fee = conn.execute("SELECT COALESCE(SUM(fee),0) AS s FROM tx_log").fetchone()["s"]
-        users = conn.execute("SELECT COUNT(*) AS c FROM users WHERE user_id>0").fetchone()["c"]
-        since = (datetime.utcnow() - timedelta(days=30)).isoformat()
-        active = conn.execute("""SELECT COUNT(DISTINCT u) AS c FROM (
-                                   SELECT user_from AS u, created_at FROM tx_log
-                                   UNION ALL
-                                   SELECT user_to AS u, created_at FROM tx_log
-                                 ) WHERE u IS NOT NULL AND u>0 AND datetime(created_at)>datetime(?)
-                              """, (since,)).fetchone()["c"]
-        held = conn.execute("SELECT COALESCE(SUM(held),0) AS h FROM balances WHERE asset='SOL' AND user_id>0").fetchone()["h"]
-        txt = T(c.from_user.id,"admin_title", fee=f"{Decimal(str(fee)):.9f} SOL", users=users, active=active, held=f"{Decimal(str(held)):.9f} SOL")
+        # Stats (aus den Rollups, siehe ensure_stats_schema)
+        tot = stats_totals()
+        txt = T(c.from_user.id,"admin_title", fee=fmt_u("SOL", tot["stats_fees"]), users=tot["stats_users"],
+                active=stats_active_users(30), held=fmt_u("SOL", tot["stats_held"]))
         kb = InlineKeyboardMarkup()
+        kb.add(InlineKeyboardButton(T(c.from_user.id,"admin_btn_stats", days=30), callback_data="admin:stats:30"),
+               InlineKeyboardButton(T(c.from_user.id,"admin_btn_stats", days=90), callback_data="admin:stats:90"))
         kb.add(InlineKeyboardButton(T(c.from_user.id,"admin_btn_edit_balance"), callback_data="admin:editbal"))
+        kb.add(InlineKeyboardButton(T(c.from_user.id,"admin_btn_payout"), callback_data="admin:payout"))
         safe_edit(c.message.chat.id, c.message.message_id, txt, reply_markup=kb)
         return
 
+    if data.startswith("admin:stats:") and is_admin(c.from_user.id):
+        days = 90 if data.endswith(":90") else 30
+        kb = InlineKeyboardMarkup()
+        kb.add(InlineKeyboardButton("⬅️ Back", callback_data="m:admin"))
+        safe_edit(c.message.chat.id, c.message.message_id, stats_report(c.from_user.id, days), reply_markup=kb)
+        return
+
+    if data=="admin:payout" and is_admin(c.from_user.id):
+        msg = bot.send_message(c.message.chat.id, T(c.from_user.id,"admin_payout_prompt"))
+        next_step(msg.chat.id, "payout_csv")
+        return
+
     if data=="admin:editbal" and is_admin(c.from_user.id):
         msg = bot.send_message(c.message.chat.id, T(c.from_user.id,"admin_edit_prompt"))
-        def take_edit(m):
-            try:
-                parts = (m.text or "").strip().split()
-                uid = int(parts[0]); amount = Decimal(parts[1])
-                # ensure user & asset
-                r = get_user(uid)
-                if not r: raise ValueError("no user")
-                bal_adj(uid, "SOL", da=amount)
-                av,_ = bal(uid, "SOL")
-                bot.reply_to(m, T(c.from_user.id,"admin_edit_ok", av=fmt("SOL", av)))
-            except Exception:
-                bot.reply_to(m, T(c.from_user.id,"admin_edit_err"))
-        bot.register_next_step_handler(msg, take_edit)
+        next_step(msg.chat.id, "admin_edit")
         return
 
     if data in ("m:home","m:bal"):
@@ -742,41 +2343,23 @@ def on_cb(c):
 
     elif data=="m:dep":
         msg = bot.send_message(c.message.chat.id, T(c.from_user.id,"deposit_ask_source"))
-        bot.register_next_step_handler(msg, lambda x: on_deposit_source(c.from_user.id, x))
+        next_step(msg.chat.id, "deposit_source", uid=c.from_user.id)
 
     elif data=="m:send":
         msg=bot.send_message(c.message.chat.id, T(c.from_user.id,"send_who"))
-        bot.register_next_step_handler(msg, send_who)
-
-    elif data=="m:hist":
-        rows = conn.execute("SELECT * FROM tx_log WHERE user_from=? OR user_to=? ORDER BY datetime(created_at) DESC LIMIT 20",
-                            (c.from_user.id, c.from_user.id)).fetchall()
-        if not rows:
-            txt = T(c.from_user.id,"history_none")
-        else:
-            out=["🧾 <b>Verlauf</b>"]
-            for r in rows:
-                meta = json.loads(r["meta"] or "{}")
-                sig = r["chain_sig"] or "-"
-                if r["type"]=="deposit":
-                    out.append(f"➕ {fmt(r['asset'], r['amount'])} | tx: <code>{sig}</code>")
-                elif r["type"]=="send":
-                    other = r["user_to"]
-                    out.append(f"📤 {fmt(r['asset'], r['amount'])} → @{get_username(other)} (fee {Decimal(str(r['fee']))}%)")
-                elif r["type"]=="escrow_hold":
-                    other = r["user_to"]
-                    out.append(f"🛡️ HOLD {fmt(r['asset'], r['amount'])} → @{get_username(other)} (fee {Decimal(str(r['fee']))}%)")
-                elif r["type"]=="escrow_release":
-                    other = r["user_to"]
-                    out.append(f"✅ RELEASE {fmt(r['asset'], r['amount'])} → @{get_username(other)}")
-                elif r["type"]=="withdraw":
-                    out.append(f"💸 {fmt(r['asset'], r['amount'])} → {meta.get('to','addr')} | tx: <code>{sig}</code>")
-            txt="\n".join(out)
-        safe_edit(c.message.chat.id, c.message.message_id, txt, reply_markup=menu(c.from_user.id))
+        next_step(msg.chat.id, "send_who")
+
+    elif data=="m:hist" or data.startswith("hist:"):
+        # hist:o:<ts>:<id> → ältere Seite, hist:n:<ts>:<id> → neuere Seite
+        parts = data.split(":")
+        key = (int(parts[2]), parts[3]) if len(parts)==4 else None
+        txt, kb = history_page(c.from_user.id, older_than=key if parts[1:2]==["o"] else None,
+                               newer_than=key if parts[1:2]==["n"] else None)
+        safe_edit(c.message.chat.id, c.message.message_id, txt, reply_markup=kb)
 
     elif data=="m:wd":
         msg=bot.send_message(c.message.chat.id, T(c.from_user.id,"withdraw_addr", min=f"{MIN_WITHDRAW_SOL} SOL"))
-        bot.register_next_step_handler(msg, wd_addr)
+        next_step(msg.chat.id, "wd_addr")
 
     elif data=="m:set":
         u=get_user(c.from_user.id); twofa="AN" if u["twofa_enabled"] else "AUS"
@@ -794,38 +2377,24 @@ def on_cb(c):
     elif data=="set:2fa":
         u=get_user(c.from_user.id)
         val=0 if u["twofa_enabled"] else 1
-        conn.execute("UPDATE users SET twofa_enabled=? WHERE user_id=?", (val, c.from_user.id)); conn.commit()
+        update_user(c.from_user.id, twofa_enabled=val)
         bot.answer_callback_query(c.id, T(c.from_user.id,"twofa_toggled", st=("AN" if val else "AUS")))
         on_cb(type("obj",(),{"data":"m:set","from_user":c.from_user,"message":c.message,"id":c.id}))
 
     elif data=="set:pw":
-        uid=c.from_user.id
-        msg=bot.send_message(c.message.chat.id, T(uid,"set_pw_prompt"))
-        def first(m):
-            pw1=(m.text or "")
-            if len(pw1)<4: bot.reply_to(m, T(uid,"pw_short")); return
-            msg2=bot.reply_to(m, T(uid,"set_pw_confirm"))
-            def second(m2):
-                pw2=(m2.text or "")
-                if pw2!=pw1: bot.reply_to(m2, T(uid,"pw_mismatch")); return
-                salt=secrets.token_hex(16)
-                h=_hash_pw(pw1, salt)
-                conn.execute("UPDATE users SET pass_enabled=1, pw_hash=?, pw_salt=? WHERE user_id=?",(h,salt,uid)); conn.commit()
-                bot.reply_to(m2, T(uid,"set_pw_ok"), reply_markup=menu(uid))
-            bot.register_next_step_handler(msg2, second)
-        bot.register_next_step_handler(msg, first)
+        msg=bot.send_message(c.message.chat.id, T(c.from_user.id,"set_pw_prompt"))
+        next_step(msg.chat.id, "set_pw", uid=c.from_user.id)
 
     elif data=="set:pwdel":
         uid=c.from_user.id
-        conn.execute("UPDATE users SET pass_enabled=0, pw_hash=NULL, pw_salt=NULL WHERE user_id=?", (uid,))
-        conn.commit()
+        update_user(uid, pass_enabled=0, pw_hash=None, pw_salt=None)
         bot.answer_callback_query(c.id, T(uid,"del_pw_ok"))
         on_cb(type("obj",(),{"data":"m:set","from_user":c.from_user,"message":c.message,"id":c.id}))
 
     elif data.startswith("set:lang:"):
         lang=data.split(":")[2]
         if lang in ("de","en"):
-            conn.execute("UPDATE users SET lang=? WHERE user_id=?", (lang, c.from_user.id)); conn.commit()
+            update_user(c.from_user.id, lang=lang)
         on_cb(type("obj",(),{"data":"m:set","from_user":c.from_user,"message":c.message,"id":c.id}))
 
     elif data.startswith("esc:release:"):
@@ -833,103 +2402,327 @@ def on_cb(c):
         tr = conn.execute("SELECT * FROM tx_log WHERE id=? AND type='escrow_hold'", (t_id,)).fetchone()
         if not tr or tr["user_from"]!=c.from_user.id:
             bot.answer_callback_query(c.id, "Nicht zulässig.", show_alert=True); return
-        amt=Decimal(str(tr["amount"])); asset=tr["asset"]; seller=tr["user_to"]
-        av,hd = bal(seller, asset)
-        if hd < amt:
+        asset=tr["asset"]; amt=from_units(asset, tr["amount"]); seller=tr["user_to"]
+        try:
+            with ledger_tx():
+                bal_adj(seller, asset, da=amt, dh=-amt)
+                tx_log_add("escrow_release", tr["user_from"], tr["user_to"], asset, amt)
+        except InsufficientBalance:
             bot.answer_callback_query(c.id, "Fehler: nicht genug gehalten.", show_alert=True); return
-        bal_set(seller, asset, av+amt, hd-amt)
-        conn.execute("INSERT INTO tx_log(id,type,user_from,user_to,asset,amount,fee,chain_sig,meta,created_at) VALUES(?,?,?,?,?,?,?,?,?,?)",
-                     (str(uuid.uuid4()),"escrow_release",tr["user_from"],tr["user_to"],asset,float(amt),0,None,"{}",now_iso()))
-        conn.commit()
         bot.answer_callback_query(c.id, T(c.from_user.id,"escrow_release_ok"))
-        bot.send_message(tr["user_to"], "✅ Betrag aus Escrow freigegeben.")
+        notify(tr["user_to"], "✅ Betrag aus Escrow freigegeben.")
 
     elif data.startswith("esc:dispute:"):
         t_id=data.split(":")[2]
         tr = conn.execute("SELECT * FROM tx_log WHERE id=? AND type='escrow_hold'", (t_id,)).fetchone()
         if not tr:
             bot.answer_callback_query(c.id, "Nicht zulässig.", show_alert=True); return
+        names=usernames([tr["user_from"], tr["user_to"]])
         for a in ADMIN_IDS:
-            bot.send_message(a, f"⚠️ Dispute: BUYER @{get_username(tr['user_from'])} vs SELLER @{get_username(tr['user_to'])} | {fmt(tr['asset'],tr['amount'])}\nTxID: {t_id}")
+            notify(a, f"⚠️ Dispute: BUYER @{names[tr['user_from']]} vs SELLER @{names[tr['user_to']]} | {fmt_u(tr['asset'],tr['amount'])}\nTxID: {t_id}", prio=PRIO_INFO)
         bot.answer_callback_query(c.id, T(c.from_user.id,"escrow_dispute_open"))
 
 # ------------------ WITHDRAW (echte On-Chain) --------------
-def _extract_sig(resp):
-    try:
-        if isinstance(resp, str):
-            return resp
-        if hasattr(resp, "value"):
-            v = getattr(resp, "value")
-            if isinstance(v, str) and len(v) > 40:
-                return v
-        if isinstance(resp, dict):
-            if isinstance(resp.get("result"), str):
-                return resp["result"]
-            if isinstance(resp.get("value"), str):
-                return resp["value"]
-            if isinstance(resp.get("result"), dict):
-                inner = resp["result"]
-                if isinstance(inner.get("value"), str):
-                    return inner["value"]
-        return str(resp)
-    except Exception:
-        return str(resp)
-
-def _get_blockhash_robust():
-    rb = rpc.get_recent_blockhash()
-    if isinstance(rb, dict):
-        if "blockhash" in rb: return rb["blockhash"]
-        if "result" in rb and isinstance(rb["result"], dict):
-            val = rb["result"].get("value", {})
-            if isinstance(val, dict) and "blockhash" in val:
-                return val["blockhash"]
-        if "value" in rb and isinstance(rb["value"], dict) and "blockhash" in rb["value"]:
-            return rb["value"]["blockhash"]
-    if hasattr(rb, "value"):
-        v = getattr(rb, "value")
-        if isinstance(v, str): return v
-        if isinstance(v, dict) and "blockhash" in v: return v["blockhash"]
-        if hasattr(v, "blockhash"): return getattr(v, "blockhash")
-    try:
-        lr = rpc_post("getLatestBlockhash", [{}])
-        if isinstance(lr, dict):
-            v = lr.get("value", {})
-            if isinstance(v, dict):
-                bh = v.get("blockhash") or (v.get("blockhashes", [None])[0] if isinstance(v.get("blockhashes"), list) else None)
-                if bh: return bh
-    except Exception:
-        pass
-    raise RuntimeError("Kein Blockhash vom RPC erhalten")
-
-def withdraw_sol(to_addr: str, sol_amt: Decimal) -> str:
-    if not re.fullmatch(r"[1-9A-HJ-NP-Za-km-z]{32,44}", to_addr or ""):
-        raise ValueError("invalid address")
-    to_pk = PublicKey(to_addr)
-    ix = transfer(TransferParams(
-        from_pubkey=kp.public_key,
-        to_pubkey=to_pk,
-        lamports=int(sol_amt * Decimal(1_000_000_000))
-    ))
+class BlockhashCache:
+    """Neuester Blockhash samt lastValidBlockHeight, im Hintergrund alle BLOCKHASH_REFRESH_SECONDS erneuert
+    (getLatestBlockhash + getBlockHeight als ein Batch, commitment confirmed). get() kostet keinen RPC-Roundtrip;
+    ein Hash, dessen hochgerechnete Blockhöhe näher als BLOCKHASH_SAFETY_BLOCKS am Ablauf liegt, wird nie herausgegeben.
+    Abgerufen wird immer beim Send-Endpoint (rpc_pool.best()): dessen Preflight muss den Hash schon kennen."""
+    SLOT_SECONDS = 0.4
+
+    def __init__(self, refresh, safety):
+        self.refresh_s, self.safety = refresh, safety
+        self.cur = None   # (blockhash, last_valid_height, block_height, monotonic beim Abruf, endpoint)
+        self.fetch_lock = threading.Lock()
+
+    def height(self, cur=None):
+        """Geschätzte aktuelle Blockhöhe (seit dem letzten Abruf hochgerechnet), None ohne Daten."""
+        cur = cur or self.cur
+        return cur[2] + int((time.monotonic() - cur[3]) / self.SLOT_SECONDS) if cur else None
+
+    def _usable(self, cur):
+        return cur is not None and cur[4] is rpc_pool.best() and self.height(cur) < cur[1] - self.safety
+
+    def refresh(self):
+        with self.fetch_lock:
+            ep = rpc_pool.best()
+            body = [{"jsonrpc":"2.0","id":0,"method":"getLatestBlockhash","params":[{"commitment":"confirmed"}]},
+                    {"jsonrpc":"2.0","id":1,"method":"getBlockHeight","params":[{"commitment":"confirmed"}]}]
+            _, j = _http_post(ep, body, n=2)
+            by_id = {x.get("id"): x for x in j if isinstance(x, dict)} if isinstance(j, list) else {}
+            bh, hgt = by_id.get(0, {}), by_id.get(1, {})
+            if "result" not in bh or "result" not in hgt:
+                raise RuntimeError(f"Blockhash: {bh.get('error') or hgt.get('error') or 'keine Batch-Antwort'}")
+            v = bh["result"]["value"]
+            self.cur = (v["blockhash"], int(v["lastValidBlockHeight"]), int(hgt["result"]), time.monotonic(), ep)
+            return self.cur
+
+    def get(self):
+        """(blockhash, last_valid_height, endpoint). Synchron geholt wird nur, wenn der Hintergrund-Refresh
+        hängt oder der Send-Endpoint gewechselt hat."""
+        cur = self.cur
+        if not self._usable(cur):
+            cur = self.refresh()
+        return cur[0], cur[1], cur[4]
+
+    def loop(self):
+        while True:
+            try: self.refresh()
+            except Exception as e: print("Blockhash-Fehler:", e)
+            time.sleep(self.refresh_s)
+
+blockhash_cache = BlockhashCache(BLOCKHASH_REFRESH_SECONDS, BLOCKHASH_SAFETY_BLOCKS)
+
+PACKET_DATA_SIZE = 1232                              # max. Größe einer Transaktion (Bytes)
+_SIZE_BLOCKHASH = "11111111111111111111111111111111"   # Platzhalter nur für Größenberechnung
+
+def build_transfer_tx(transfers, memo: str):
+    """Unsignierte Tx: ein transfer je (Adresse, Lamports) vom zentralen Wallet + Memo.
+    Das Memo (Job-ID) macht gleiche Beträge an dieselbe Adresse im selben Blockhash-Fenster unterscheidbar –
+    sonst wären Tx und Signatur identisch und nur eine davon würde ausgeführt."""
     tx = Transaction(fee_payer=kp.public_key)
-    tx.add(ix)
-    tx.recent_blockhash = _get_blockhash_robust()
+    for to_addr, lamports in transfers:
+        if not is_valid_pubkey(to_addr):
+            raise ValueError("invalid address")
+        tx.add(transfer(TransferParams(from_pubkey=kp.public_key, to_pubkey=PublicKey(to_addr), lamports=int(lamports))))
+    tx.add(create_memo(MemoParams(program_id=MEMO_PROGRAM_ID, signer=kp.public_key, message=memo.encode())))
+    return tx
+
+def tx_size(tx):
+    if tx.recent_blockhash is None: tx.recent_blockhash = _SIZE_BLOCKHASH
+    return 1 + 64 + len(tx.serialize_message())   # eine Signatur (Fee-Payer)
+
+def sign_withdraw(transfers, blockhash, memo: str) -> tuple:
+    """Signierte Tx → (raw, sig); die Signatur steht vor dem Senden fest."""
+    tx = build_transfer_tx(transfers, memo)
+    tx.recent_blockhash = blockhash
     tx.sign(kp)
-    raw = tx.serialize()
-    resp = rpc.send_raw_transaction(raw, opts=TxOpts(skip_preflight=False, max_retries=5))
-    sig = _extract_sig(resp)
+    return tx.serialize(), str(tx.signature())
+
+def _est_tx_size(n_transfers, n_recipients, memo_len):
+    """Größe einer build_transfer_tx-Tx ohne sie zu bauen: Payer, System- und Memo-Programm + Empfänger als
+    Accounts, je transfer 17 Bytes (Programm, 2 Account-Indizes, 12 Byte Daten), Memo mit Signer-Index."""
+    cu = lambda n: 1 if n < 0x80 else 2   # compact-u16
+    keys = 3 + n_recipients
+    return 1 + 64 + 3 + cu(keys) + 32*keys + 32 + cu(n_transfers+1) + 17*n_transfers + 3 + cu(memo_len) + memo_len
+
+def pack_transfers(items, memo_len=45):
+    """items [(Adresse, Lamports, x), ...] greedy in möglichst wenige Gruppen, deren Tx in PACKET_DATA_SIZE passt.
+    Gerechnet wird mit _est_tx_size; jede fertige Gruppe wird einmal real gebaut und notfalls geteilt."""
+    groups, cur, addrs = [], [], set()
+    for it in items:
+        n_rcpt = len(addrs | {it[0]})
+        full = PAYOUT_MAX_PER_TX and len(cur) >= PAYOUT_MAX_PER_TX
+        if cur and (full or _est_tx_size(len(cur)+1, n_rcpt, memo_len) > PACKET_DATA_SIZE):
+            groups.append(cur); cur, addrs = [], set()
+        cur.append(it); addrs.add(it[0])
+    if cur: groups.append(cur)
+    out = []
+    while groups:
+        g = groups.pop(0)
+        if len(g) > 1 and tx_size(build_transfer_tx([(a, l) for a, l, _ in g], "x"*memo_len)) > PACKET_DATA_SIZE:
+            groups[:0] = [g[:len(g)//2], g[len(g)//2:]]; continue
+        out.append(g)
+    return out
+
+# --- Auszahlungs-Jobs ---
+# Der Handler reserviert nur (Abbuchung + Job-Zeile in einer Transaktion) und kehrt sofort zurück.
+# Worker erledigen je Aufruf genau einen kurzen Schritt (signieren+senden / erstatten); fällige Jobs plant
+# wd_sweep_loop aus der DB ein (auch nach Neustart). Gesendete verfolgt wd_track_loop gesammelt.
+wd_queue = queue.Queue()
+_wd_sched = {}    # jid → "queued" (in wd_queue) | "running" | "again" (während der Arbeit erneut angefordert)
+_wd_lock = threading.Lock()
+
+def wd_schedule(jid, rerun=True):
+    """Job einplanen; steht er schon in der Queue, nichts tun. Läuft er gerade: mit rerun danach noch einmal."""
+    with _wd_lock:
+        st = _wd_sched.get(jid)
+        if st is None:
+            _wd_sched[jid] = "queued"; wd_queue.put(jid)
+        elif st == "running" and rerun:
+            _wd_sched[jid] = "again"
+
+def wd_enqueue(uid, chat_id, to_addr, amt):
+    """Betrag reservieren und Job anlegen → Job-ID. InsufficientBalance, wenn nicht gedeckt."""
+    jid = str(uuid.uuid4()); ts = now_ms()
+    with ledger_tx():
+        bal_adj(uid, "SOL", da=-amt)
+        conn.execute("""INSERT INTO withdrawals(id,user_id,chat_id,asset,amount,to_addr,state,created_ts,updated_ts,next_ts)
+                        VALUES(?,?,?,?,?,?,'queued',?,?,0)""", (jid, uid, chat_id, "SOL", to_units("SOL", amt), to_addr, ts, ts))
+    wd_schedule(jid)
+    return jid
+
+def _wd_set(jid, frm, **cols):
+    """Zustandswechsel nur aus Zustand frm (nie doppelt senden/erstatten). Nur innerhalb von ledger_tx()."""
+    cols["updated_ts"] = now_ms()
+    sql = f"UPDATE withdrawals SET {', '.join(k+'=?' for k in cols)} WHERE id=? AND state=?"
+    return conn.execute(sql, (*cols.values(), jid, frm)).rowcount == 1
+
+def _wd_later(jid, seconds):
+    conn.execute("UPDATE withdrawals SET next_ts=? WHERE id=?", (now_ms() + int(seconds*1000), jid))
+
+def _wd_transfers(j):
+    if not j["batch_id"]: return [(j["to_addr"], j["amount"])]
+    return [(r["to_addr"], r["amount"]) for r in
+            conn.execute("SELECT to_addr, amount FROM payout_items WHERE wd_id=? ORDER BY row_no", (j["id"],)).fetchall()]
+
+def wd_submit(j):
+    blockhash, last_valid, ep = blockhash_cache.get()
+    raw, sig = sign_withdraw(_wd_transfers(j), blockhash, memo=f"proofpay:{j['id']}")
+    # Signatur vor dem Senden festhalten: nach Absturz/Timeout entscheidet der Chain-Status, nicht ein Resend
+    with ledger_tx():
+        if not _wd_set(j["id"], "queued", state="submitted", sig=sig, attempts=j["attempts"]+1, last_valid_height=last_valid,
+                       chain_status=None, submitted_ts=now_ms()): return
     try:
-        rpc.confirm_transaction(sig)
-    except Exception:
-        pass
-    return sig
+        # Preflight auf demselben Endpoint und Commitment wie der Blockhash (Default wäre finalized → "Blockhash not found")
+        ep.client().send_raw_transaction(raw, opts=TxOpts(skip_preflight=False, preflight_commitment="confirmed", max_retries=5))
+    except RPCException as e:   # vom Knoten abgelehnt (Preflight) → kommt nicht on-chain
+        with ledger_tx(): _wd_set(j["id"], "submitted", state="failed", error=str(e), next_ts=0)
+        wd_schedule(j["id"])
+
+# --- Status-Tracker: alle offenen Signaturen je Takt in einem HTTP-Request (Batch, je Call max. 256) ---
+WD_STATUS_CHUNK = 256
+WD_STATUS_RANK = {"processed": 1, "confirmed": 2, "finalized": 3}
+
+def _wd_statuses(sigs, history=False):
+    """→ (sig → Status-Dict oder None, finalisierte Blockhöhe); ein Batch-Request mit je einem
+    getSignatureStatuses pro 256 Signaturen und getBlockHeight (vom selben Stand wie die Status)."""
+    chunks = [sigs[i:i+WD_STATUS_CHUNK] for i in range(0, len(sigs), WD_STATUS_CHUNK)]
+    res = rpc_batch([("getSignatureStatuses", [c, {"searchTransactionHistory": history}]) for c in chunks]
+                    + [("getBlockHeight", [{"commitment": "finalized"}])])
+    for r in res:
+        if isinstance(r, Exception): raise r
+    out = {}
+    for chunk, r in zip(chunks, res):
+        out.update(zip(chunk, r["value"]))
+    return out, int(res[-1])
+
+def wd_confirm(j, status):
+    ts = now_ms(); amt = from_units(j["asset"], j["amount"])
+    with ledger_tx():
+        if not _wd_set(j["id"], "submitted", state="confirmed", chain_status=status, confirmed_ts=ts,
+                       confirm_ms=ts - (j["submitted_ts"] or ts), finalized_ts=ts if status=="finalized" else None): return
+        if j["batch_id"]:
+            items = conn.execute("SELECT * FROM payout_items WHERE wd_id=? AND state='pending'", (j["id"],)).fetchall()
+            for it in items:
+                tx_log_add("withdraw", it["debit_uid"], None, j["asset"], from_units(j["asset"], it["amount"]), chain_sig=j["sig"],
+                           meta={"to": it["to_addr"], "batch": j["batch_id"]})
+            conn.execute("UPDATE payout_items SET state='paid' WHERE wd_id=? AND state='pending'", (j["id"],))
+        else:
+            tx_log_add("withdraw", j["user_id"], None, j["asset"], amt, chain_sig=j["sig"], meta={"to": j["to_addr"]}, t_id=j["id"])
+    if j["batch_id"]:
+        for it in items:
+            if it["debit_uid"] > 0:
+                notify(it["debit_uid"], T(it["debit_uid"],"withdraw_ok", amt=fnum(from_units(j["asset"], it["amount"])), sig=j["sig"]), coalesce="withdraw")
+        payout_maybe_report(j["batch_id"]); return
+    notify(j["chat_id"] or j["user_id"], T(j["user_id"],"withdraw_ok", amt=fnum(amt), sig=j["sig"]), reply_markup=menu(j["user_id"]))
+
+def wd_expire(j):
+    """Blockhash abgelaufen, Tx nie gelandet → kann auch nicht mehr landen: neu signieren oder erstatten."""
+    if j["attempts"] < WITHDRAW_MAX_ATTEMPTS:
+        with ledger_tx(): ok = _wd_set(j["id"], "submitted", state="queued", error=f"expired: {j['sig']}", next_ts=0)
+    else:
+        with ledger_tx(): ok = _wd_set(j["id"], "submitted", state="failed", error="expired", next_ts=0)
+    if ok: wd_schedule(j["id"])
+
+def wd_track_once():
+    jobs = conn.execute(f"SELECT * FROM withdrawals WHERE {WD_TRACKED}").fetchall()
+    jobs = [j for j in jobs if j["sig"]]
+    if not jobs: return
+    # echte (finalisierte) Blockhöhe statt der Hochrechnung des Blockhash-Caches: die überschätzt bei
+    # übersprungenen Slots, und ein zu frühes Neu-Signieren kann doppelt auszahlen
+    st, height = _wd_statuses([j["sig"] for j in jobs])
+    lapsed = []
+    for j in jobs:
+        s_ = st.get(j["sig"])
+        if j["state"]=="confirmed":
+            if s_ and s_.get("confirmationStatus")=="finalized":
+                with ledger_tx(): _wd_set(j["id"], "confirmed", chain_status="finalized", finalized_ts=now_ms())
+            continue
+        if s_ and s_.get("err"):
+            with ledger_tx(): ok = _wd_set(j["id"], "submitted", state="failed", error=f"on-chain: {s_['err']}", next_ts=0)
+            if ok: wd_schedule(j["id"])
+        elif s_ and WD_STATUS_RANK.get(s_.get("confirmationStatus"), 0) >= 2:
+            wd_confirm(j, s_["confirmationStatus"])
+        elif s_:
+            if j["chain_status"] != "processed":
+                with ledger_tx(): _wd_set(j["id"], "submitted", chain_status="processed")
+        elif j["last_valid_height"] and height > j["last_valid_height"] + WITHDRAW_EXPIRE_MARGIN:
+            lapsed.append(j)
+    if lapsed:
+        # vor dem Neu-Signieren einmal mit Historie prüfen (Status-Cache des Knotens ist kurz)
+        st, _ = _wd_statuses([j["sig"] for j in lapsed], history=True)
+        for j in lapsed:
+            if st.get(j["sig"]) is None: wd_expire(j)
+
+def wd_track_loop():
+    while True:
+        try: wd_track_once()
+        except Exception as e: print("Withdraw-Tracker-Fehler:", e)
+        time.sleep(WITHDRAW_CHECK_SECONDS)
+
+def wd_refund(j):
+    amt = from_units(j["asset"], j["amount"])
+    with ledger_tx():
+        if not _wd_set(j["id"], "failed", state="refunded"): return
+        if j["batch_id"]:
+            for it in conn.execute("SELECT debit_uid, amount FROM payout_items WHERE wd_id=? AND state='pending'", (j["id"],)).fetchall():
+                bal_adj(it["debit_uid"], j["asset"], da=from_units(j["asset"], it["amount"]))
+            conn.execute("UPDATE payout_items SET state='refunded', error=? WHERE wd_id=? AND state='pending'", (j["error"], j["id"]))
+        else:
+            bal_adj(j["user_id"], j["asset"], da=amt)
+    if j["batch_id"]:
+        payout_maybe_report(j["batch_id"]); return
+    err = j["error"] or ""
+    txt = T(j["user_id"],"err_rpc") if err.startswith("rpc:") else f"Auszahlung fehlgeschlagen: {err}"
+    notify(j["chat_id"] or j["user_id"], txt, reply_markup=menu(j["user_id"]))
+
+def wd_process(jid):
+    j = conn.execute("SELECT * FROM withdrawals WHERE id=?", (jid,)).fetchone()
+    if not j: return
+    try:
+        if j["state"]=="queued": wd_submit(j)
+        elif j["state"]=="failed": wd_refund(j)
+    except Exception as e:
+        if j["state"]=="queued":
+            # vor dem Senden gescheitert (Blockhash, Adresse, RPC) → nichts on-chain, erstatten
+            err = f"rpc: {e}" if isinstance(e, requests.RequestException) else str(e)
+            with ledger_tx(): _wd_set(jid, "queued", state="failed", error=err, next_ts=0)
+            wd_schedule(jid)
+        else:
+            print("Withdraw-Job-Fehler:", jid, e)
+            _wd_later(jid, WITHDRAW_SWEEP_SECONDS)
+
+def wd_worker():
+    while True:
+        jid = wd_queue.get()
+        with _wd_lock: _wd_sched[jid] = "running"
+        try: wd_process(jid)
+        except Exception as e: print("Withdraw-Worker-Fehler:", e)
+        finally:
+            with _wd_lock:
+                if _wd_sched.pop(jid, None) == "again":
+                    _wd_sched[jid] = "queued"; wd_queue.put(jid)
+
+def wd_sweep_loop():
+    while True:
+        try:
+            for r in conn.execute("""SELECT id FROM withdrawals WHERE state IN ('queued','failed') AND next_ts<=?
+                                     ORDER BY next_ts LIMIT 500""", (now_ms(),)).fetchall():
+                wd_schedule(r["id"], rerun=False)   # wartende/laufende Jobs nicht doppelt
+        except Exception as e:
+            print("Withdraw-Sweep-Fehler:", e)
+        time.sleep(WITHDRAW_SWEEP_SECONDS)
 
+@step("wd_addr")
 def wd_addr(m):
     addr=(m.text or "").strip()
     if not is_valid_pubkey(addr):
         bot.reply_to(m, T(m.from_user.id,"err_addr")); return
     msg=bot.reply_to(m, T(m.from_user.id,"withdraw_amt", min=f"{MIN_WITHDRAW_SOL} SOL", max=f"{MAX_WITHDRAW_SOL} SOL"))
-    bot.register_next_step_handler(msg, lambda x: wd_amount(x, addr))
+    next_step(msg.chat.id, "wd_amount", to_addr=addr)
 
+@step("wd_amount")
 def wd_amount(m, to_addr):
     try:
         amt = Decimal((m.text or "").replace(",",".").strip())
@@ -939,67 +2732,275 @@ def wd_amount(m, to_addr):
     av,_=bal(m.from_user.id, "SOL")
     if amt>av:
         bot.reply_to(m, T(m.from_user.id,"err_balance", av=fmt("SOL",av))); return
+    guard(m.chat.id, m.from_user.id, "withdraw", {"to_addr": to_addr, "amt": str(amt)})
 
-    u=get_user(m.from_user.id)
-
-    def finalize_send():
+@guarded("withdraw")
+def wd_request(chat_id, uid, to_addr, amt):
+    # Betrag sofort reservieren; Senden/Bestätigen/Erstatten übernimmt der Withdraw-Worker
+    try:
+        wd_enqueue(uid, chat_id, to_addr, dquant(Decimal(amt),9))
+    except InsufficientBalance:
+        av,_=bal(uid, "SOL")
+        notify(chat_id, T(uid,"err_balance", av=fmt("SOL",av))); return
+    notify(chat_id, T(uid,"withdraw_queued", amt=fnum(amt)), reply_markup=menu(uid))
+
+# ------------------ ADMIN PAYOUTS (CSV) -------------------
+def parse_payout_csv(text):
+    """Zeilen 'ziel,betrag' (Trenner , ; oder Tab, Dezimalpunkt); ziel = user_id oder Solana-Adresse.
+    Leerzeilen, #-Kommentare und eine Kopfzeile werden übersprungen. → [(zeile, ziel, Decimal|None, fehler|None)]"""
+    rows = []
+    for no, line in enumerate((text or "").splitlines(), 1):
+        line = line.strip()
+        if not line or line.startswith("#"): continue
+        parts = [p.strip() for p in re.split(r"[,;\t]", line)]
         try:
-            sig = withdraw_sol(to_addr, dquant(amt,9))
-        except requests.HTTPError:
-            bot.reply_to(m, T(m.from_user.id,"err_rpc")); return
-        except Exception as e:
-            bot.reply_to(m, f"Auszahlung fehlgeschlagen: {e}"); return
-        bal_adj(m.from_user.id, "SOL", da=-amt)
-        meta={"to": to_addr}
-        conn.execute("INSERT INTO tx_log VALUES(?,?,?,?,?,?,?,?,?,?)",
-                     (str(uuid.uuid4()),"withdraw",m.from_user.id,None,"SOL",float(amt),0,str(sig),json.dumps(meta),now_iso()))
-        conn.commit()
-        bot.reply_to(m, T(m.from_user.id,"withdraw_ok", amt=str(amt), sig=str(sig)), reply_markup=menu(m.from_user.id))
-
-    def after_pw():
-        if u["twofa_enabled"]:
-            code=''.join(random.choices(string.digits,k=6))
-            bot.reply_to(m, f"🔐 2FA – antworte mit: <code>{code}</code>")
-            def check_code(x):
-                if (x.text or "").strip()!=code: bot.reply_to(x,"Falscher Code."); return
-                finalize_send()
-            bot.register_next_step_handler(m, check_code)
+            amt = Decimal(parts[1])
+            if not amt.is_finite() or amt <= 0 or dquant(amt, 9) != amt: raise ValueError
+        except Exception:
+            if not rows and no == 1: continue   # Kopfzeile
+            rows.append((no, parts[0], None, "Betrag ungültig")); continue
+        rows.append((no, parts[0], amt, None))
+    return rows
+
+def _payout_sources(uids):
+    """user_id → zuletzt hinterlegte Quell-Wallet (Auszahlungsziel für user_id-Zeilen)."""
+    out = {}
+    uids = list(dict.fromkeys(uids))
+    for off in range(0, len(uids), 400):
+        part = uids[off:off+400]
+        for r in conn.execute(f"""SELECT user_id, source_addr FROM expected_sources WHERE user_id IN ({','.join('?'*len(part))})
+                                  ORDER BY created_at""", part).fetchall():
+            out[r["user_id"]] = r["source_addr"]
+    return out
+
+_rent_min = []   # getMinimumBalanceForRentExemption(0), einmal je Prozess
+
+def _unfunded(addrs):
+    """→ (Rent-Minimum eines leeren Kontos in Lamports, Menge der Adressen ohne Konto).
+    Ein Batch: getMultipleAccounts je 100 Adressen (ohne Daten) + ggf. das Rent-Minimum."""
+    addrs = list(dict.fromkeys(addrs))
+    chunks = [addrs[i:i+100] for i in range(0, len(addrs), 100)]
+    calls = [("getMultipleAccounts", [c, {"encoding": "base64", "dataSlice": {"offset": 0, "length": 0}}]) for c in chunks]
+    res = rpc_batch(calls + ([] if _rent_min else [("getMinimumBalanceForRentExemption", [0])]))
+    for r in res:
+        if isinstance(r, Exception): raise r
+    if not _rent_min: _rent_min.append(int(res[-1]))
+    missing = {a for c, r in zip(chunks, res) for a, acc in zip(c, r["value"]) if acc is None}
+    return _rent_min[0], missing
+
+def payout_create(admin_id, chat_id, rows):
+    """Sammel-Auszahlung anlegen: alle Abbuchungen + Jobs in einer Ledger-Transaktion, Transfers dicht gepackt.
+    user_id-Zeilen belasten das Guthaben des Nutzers (Ziel: seine Quell-Wallet), Adress-Zeilen das Gebührenkonto (0)."""
+    bid = str(uuid.uuid4()); ts = now_ms()
+    uids = [int(t) for _, t, a, e in rows if not e and t.isdigit()]
+    known = {r["user_id"] for off in range(0, len(uids), 400)
+             for r in conn.execute(f"SELECT user_id FROM users WHERE user_id IN ({','.join('?'*len(uids[off:off+400]))})", uids[off:off+400]).fetchall()}
+    sources = _payout_sources(uids)
+    items = []
+    for no, target, amt, err in rows:
+        debit, addr = None, None
+        if not err:
+            if target.isdigit():
+                debit, addr = int(target), sources.get(int(target))
+                if debit not in known or debit == 0: err = "Nutzer unbekannt"
+                elif not addr: err = "keine Quell-Wallet"
+            elif is_valid_pubkey(target): debit, addr = 0, target
+            else: err = "Ziel ungültig"
+        if not err and amt < MIN_WITHDRAW_SOL: err = f"unter Minimum ({MIN_WITHDRAW_SOL} SOL)"
+        items.append({"row_no": no, "target": target, "debit_uid": debit, "to_addr": addr,
+                      "amount": to_units("SOL", amt) if amt else 0, "wd_id": None, "error": err})
+    # Transfer unter dem Rent-Minimum an ein noch nicht existierendes Konto lehnt der Preflight ab – und damit
+    # die ganze gepackte Tx. Solche Zeilen einzeln zurückweisen, bevor abgebucht wird.
+    ok_items = [it for it in items if not it["error"]]
+    if ok_items:
+        rent, missing = _unfunded([it["to_addr"] for it in ok_items])
+        for it in ok_items:
+            if it["amount"] < rent and it["to_addr"] in missing:
+                it["error"] = f"Zielkonto leer, Betrag unter Rent-Minimum ({fmt_u('SOL', rent)})"
+    jobs = []
+    with ledger_tx():
+        conn.execute("INSERT INTO payout_batches(id,admin_id,chat_id,rows,created_ts) VALUES(?,?,?,?,?)", (bid, admin_id, chat_id, len(items), ts))
+        ok = []
+        for it in items:
+            if it["error"]: continue
+            try: bal_adj(it["debit_uid"], "SOL", da=-from_units("SOL", it["amount"]))   # Guard: ohne Deckung keine Änderung
+            except InsufficientBalance: it["error"] = "Guthaben"; continue
+            ok.append(it)
+        for group in pack_transfers([(it["to_addr"], it["amount"], it) for it in ok]):
+            jid = str(uuid.uuid4()); jobs.append(jid)
+            conn.execute("""INSERT INTO withdrawals(id,user_id,chat_id,asset,amount,to_addr,state,created_ts,updated_ts,next_ts,batch_id)
+                            VALUES(?,0,NULL,'SOL',?,?,'queued',?,?,0,?)""", (jid, sum(l for _, l, _ in group), f"{len(group)} transfers", ts, ts, bid))
+            for _, _, it in group: it["wd_id"] = jid
+        conn.executemany("""INSERT INTO payout_items(batch_id,row_no,target,debit_uid,to_addr,amount,wd_id,state,error)
+                            VALUES(?,?,?,?,?,?,?,?,?)""",
+                         [(bid, it["row_no"], it["target"], it["debit_uid"], it["to_addr"], it["amount"], it["wd_id"],
+                           "rejected" if it["error"] else "pending", it["error"]) for it in items])
+    for jid in jobs: wd_schedule(jid)   # Worker senden parallel, der Tracker bestätigt alle im selben Poll
+    if not jobs: payout_maybe_report(bid)
+    return bid, len(items) - sum(1 for it in items if it["error"]), sum(1 for it in items if it["error"]), len(jobs)
+
+def payout_maybe_report(bid):
+    """Sobald keine Zeile mehr offen ist: einmalig Ergebnis-CSV je Zeile an den Admin."""
+    if conn.execute("SELECT 1 FROM payout_items WHERE batch_id=? AND state='pending' LIMIT 1", (bid,)).fetchone(): return
+    with ledger_tx():
+        if conn.execute("UPDATE payout_batches SET done_ts=? WHERE id=? AND done_ts IS NULL", (now_ms(), bid)).rowcount != 1: return
+    b = conn.execute("SELECT * FROM payout_batches WHERE id=?", (bid,)).fetchone()
+    rows = conn.execute("""SELECT p.*, w.sig FROM payout_items p LEFT JOIN withdrawals w ON w.id=p.wd_id
+                           WHERE p.batch_id=? ORDER BY p.row_no""", (bid,)).fetchall()
+    buf = io.StringIO(); w = csv.writer(buf)
+    w.writerow(["row", "target", "to_addr", "amount_sol", "status", "sig", "error"])
+    count = {}
+    for r in rows:
+        count[r["state"]] = count.get(r["state"], 0) + 1
+        w.writerow([r["row_no"], r["target"], r["to_addr"] or "", f"{from_units('SOL', r['amount']):f}", r["state"],
+                    r["sig"] if r["state"]=="paid" else "", r["error"] or ""])
+    txt = T(b["admin_id"], "admin_payout_done", paid=count.get("paid",0), refunded=count.get("refunded",0), rejected=count.get("rejected",0))
+    outbox.put(b["chat_id"] or b["admin_id"], io.BytesIO(buf.getvalue().encode()), method="send_document", prio=PRIO_INFO,
+               visible_file_name=f"payout_{bid[:8]}.csv", caption=txt)
+
+@step("payout_csv")
+def payout_csv(m):
+    if not is_admin(m.from_user.id): return
+    try:
+        if m.document:
+            text = bot.download_file(bot.get_file(m.document.file_id).file_path).decode("utf-8-sig")
         else:
-            finalize_send()
-
-    # zuerst Passwort prüfen (falls aktiv)
-    if user_has_password(m.from_user.id):
-        msg_pw = bot.reply_to(m, T(m.from_user.id,"pw_ask"))
-        def check_pw(x):
-            if not verify_password(m.from_user.id, (x.text or "")):
-                bot.reply_to(x, T(m.from_user.id,"pw_wrong")); return
-            after_pw()
-        bot.register_next_step_handler(msg_pw, check_pw)
-    else:
-        after_pw()
+            text = m.text or ""
+    except Exception as e:
+        bot.reply_to(m, f"Datei nicht lesbar: {e}"); return
+    rows = parse_payout_csv(text)
+    if not rows or len(rows) > PAYOUT_MAX_ROWS:
+        bot.reply_to(m, T(m.from_user.id,"admin_payout_empty", max=PAYOUT_MAX_ROWS)); return
+    try:
+        bid, n_ok, n_rej, n_tx = payout_create(m.from_user.id, m.chat.id, rows)
+    except (requests.RequestException, RuntimeError):   # Kontoprüfung per RPC gescheitert, nichts abgebucht
+        bot.reply_to(m, T(m.from_user.id,"err_rpc")); return
+    bot.reply_to(m, T(m.from_user.id,"admin_payout_created", ok=n_ok, rejected=n_rej, txs=n_tx, id=bid[:8]))
 
 # ------------------ SUPPORT -------------------
+@step("sup_msg")
 def sup_msg(m):
     txt=m.text or "(ohne Text)"
+    who=get_username(m.from_user.id)
     for a in ADMIN_IDS:
-        try:
-            bot.send_message(a, f"🆘 Support von @{get_username(m.from_user.id)} ({m.from_user.id}):\n\n{txt}")
-        except: pass
+        notify(a, f"🆘 Support von @{who} ({m.from_user.id}):\n\n{txt}", prio=PRIO_INFO)
     bot.reply_to(m, "Danke! Wir melden uns hier im Chat.", reply_markup=menu(m.from_user.id))
 
 # ------------------ FALLBACK ------------------
 @bot.message_handler(content_types=["text","photo","document","sticker","video","audio","voice"])
+@throttled(msg_class)
+@per_update
 def any_msg(m):
     ensure_user(m.from_user)
-    bot.send_message(m.chat.id, T(m.from_user.id,"menu"), reply_markup=menu(m.from_user.id))
+    notify(m.chat.id, T(m.from_user.id,"menu"), prio=PRIO_MENU, coalesce="menu", mode="replace", reply_markup=menu(m.from_user.id))
+
+# ------------------ UPDATES (Polling / Webhook) ------
+class UpdateDispatcher:
+    """Verteilt Updates auf n Worker nach user_id: Updates eines Nutzers (mehrstufige Flows, next_step)
+    laufen strikt nacheinander, verschiedene Nutzer parallel. Jede Shard-Queue ist begrenzt; ist sie voll,
+    blockiert submit() bis timeout (Polling bremst) bzw. liefert False (Webhook → 503, Telegram liefert erneut)."""
+    def __init__(self, n, maxsize):
+        self.queues = [queue.Queue(maxsize) for _ in range(n)]
+        self.threads = None
+
+    def start(self):
+        self.threads = [threading.Thread(target=self._worker, args=(q,), name=f"updates-{i}", daemon=True)
+                        for i, q in enumerate(self.queues)]
+        for t in self.threads: t.start()
+
+    @staticmethod
+    def shard_key(u):
+        for part in (u.message, u.edited_message, u.callback_query, u.inline_query, u.my_chat_member):
+            if part is not None and getattr(part, "from_user", None) is not None:
+                return part.from_user.id
+        return u.update_id
+
+    def submit(self, u, timeout=None):
+        try:
+            self.queues[self.shard_key(u) % len(self.queues)].put(u, timeout=timeout); return True
+        except queue.Full:
+            return False
+
+    def depth(self):
+        return [q.qsize() for q in self.queues]
+
+    def _worker(self, q):
+        while True:
+            u = q.get()
+            try: bot.process_new_updates([u])
+            except Exception as e: print("Update-Fehler:", u.update_id, e)
+
+dispatcher = UpdateDispatcher(UPDATE_WORKERS, UPDATE_QUEUE_MAX)
+
+def run_polling():
+    """Long-Polling; offene Updates vom letzten Lauf werden übersprungen (wie skip_pending)."""
+    bot.remove_webhook()
+    old = bot.get_updates(offset=-1, timeout=0)
+    offset = old[-1].update_id + 1 if old else None
+    while True:
+        try:
+            updates = bot.get_updates(offset=offset, timeout=20, long_polling_timeout=20)
+        except Exception as e:
+            print("Polling-Fehler:", e); time.sleep(3); continue
+        for u in updates:
+            dispatcher.submit(u)   # volle Shard-Queue → wartet hier, bevor neu gepollt wird
+            offset = u.update_id + 1
+
+def run_webhook():
+    """Kleiner HTTP-Server für Telegram-Webhooks (TLS terminiert davor ein Reverse-Proxy)."""
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+    path = "/tg/" + hashlib.sha256(BOT_TOKEN.encode()).hexdigest()[:32]
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            if self.path != path or (WEBHOOK_SECRET and self.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET):
+                self.send_response(403); self.end_headers(); return
+            try:
+                body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                u = telebot.types.Update.de_json(body.decode("utf-8"))
+            except Exception:
+                self.send_response(400); self.end_headers(); return
+            self.send_response(200 if dispatcher.submit(u, timeout=2) else 503); self.end_headers()
+        def log_message(self, *a): pass
+    srv = ThreadingHTTPServer((WEBHOOK_LISTEN, WEBHOOK_PORT), Handler)
+    bot.remove_webhook()
+    bot.set_webhook(url=WEBHOOK_URL + path, secret_token=WEBHOOK_SECRET or None, drop_pending_updates=True,
+                    max_connections=min(100, UPDATE_WORKERS*5))
+    print(f"Webhook aktiv: {WEBHOOK_LISTEN}:{WEBHOOK_PORT}{path[:8]}…")
+    srv.serve_forever()
+
+def run_bot():
+    dispatcher.start()
+    if BOT_MODE == "webhook":
+        if not WEBHOOK_URL: raise SystemExit("BOT_MODE=webhook braucht WEBHOOK_URL")
+        run_webhook()
+    else:
+        run_polling()
 
 # ------------------ START SCANNER THREAD ------
 def start_threads():
+    source_index.load()
+    conv.load()
     t=threading.Thread(target=scan_deposits_loop, daemon=True)
     t.start()
+    if DEPOSIT_WS:
+        threading.Thread(target=ws_deposit_loop, daemon=True).start()
+    if BACKFILL_TO_SLOT > 0:
+        threading.Thread(target=backfill_loop, args=(BACKFILL_TO_SLOT,), daemon=True).start()
+    threading.Thread(target=blockhash_cache.loop, name="blockhash", daemon=True).start()
+    for i in range(WITHDRAW_WORKERS):
+        threading.Thread(target=wd_worker, name=f"withdraw-{i}", daemon=True).start()
+    threading.Thread(target=wd_sweep_loop, daemon=True).start()
+    threading.Thread(target=wd_track_loop, name="withdraw-tracker", daemon=True).start()
 
 # ------------------ MAIN ----------------------
 if __name__=="__main__":
-    print("Starting ProofPay (SOL live).")
+    if len(sys.argv)>2 and sys.argv[1]=="backfill":
+        # python bot.py backfill <slot>  → einmaliger Backfill, danach Ende
+        backfill_deposits(int(sys.argv[2])); raise SystemExit(0)
+    if len(sys.argv)>1 and sys.argv[1]=="stats-rebuild":
+        # python bot.py stats-rebuild  → Rollups/Summen aus tx_log neu berechnen
+        with conn.direct(): stats_rebuild(); conn.commit()
+        raise SystemExit(0)
+    print(f"Starting ProofPay (SOL live, {BOT_MODE}).")
     start_threads()
-    bot.infinity_polling(skip_pending=True, timeout=20)
\ No newline at end of file
+    run_bot()
\ No newline at end of file